@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+import sys
+
+import django
+from django.conf import settings
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def configure(database, **extra):
+    """Configure Django for a benchmark run against ``database``."""
+    if settings.configured:
+        return
+    options = dict(
+        DEBUG=False,
+        DATABASES={'default': database},
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sites',
+            'changuito',
+        ),
+        SITE_ID=1,
+        SECRET_KEY='this-is-just-for-benchmarks-so-not-that-secret',
+    )
+    options.update(extra)
+    settings.configure(**options)
+    django.setup()
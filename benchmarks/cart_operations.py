@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Timings and query counts of the cart operations on a seeded database.
+
+    python -m benchmarks.cart_operations --users 1000 --output results.json
+    python runtests.py --benchmark --budgets benchmarks/budgets.json
+
+The database is a temporary SQLite file unless CHANGUITO_BENCHMARK_DB holds
+a JSON ``DATABASES`` entry. Results are written as JSON so that runs can be
+compared, and ``--budgets`` fails the run when an operation issues more
+queries than allowed.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+from benchmarks import configure
+from benchmarks.seed import seed
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function does the setup of one run
+    and returns the callable that is timed.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+class Context(object):
+
+    def __init__(self, user_ids, cart_ids, products, lines):
+        from django.contrib.auth.models import User
+        self.user_ids = user_ids
+        self.cart_ids = cart_ids
+        self.products = products
+        self.lines = lines
+        self.users = dict((user.pk, user) for user in User.objects.filter(
+            pk__in=user_ids))
+
+    def request(self, user=None):
+        from django.http import HttpRequest
+        request = HttpRequest()
+        request.session = {}
+        request.user = user or self.users[random.choice(self.user_ids)]
+        return request
+
+    def proxy(self, user=None):
+        from changuito.proxy import CartProxy
+        return CartProxy(self.request(user))
+
+    def new_proxy(self):
+        # Proxy of a new empty cart, so that the queries of the operations
+        # don't depend on the lines left by earlier runs
+        from changuito.proxy import CartProxy
+        proxy = CartProxy(self.request(), lazy=True)
+        proxy.cart = CartProxy.new_cart(proxy.request.user)
+        return proxy
+
+    def product(self):
+        from changuito.products import ProductKey
+        return ProductKey(*random.choice(self.products))
+
+    def new_lines(self):
+        from changuito.products import ProductKey
+        return [(ProductKey(*key), Decimal('9.99'), 1)
+                for key in random.sample(self.products, self.lines)]
+
+    def filled_proxy(self):
+        proxy = self.new_proxy()
+        proxy.add_items(self.new_lines())
+        return proxy
+
+
+@benchmark('get_cart')
+def get_cart(ctx):
+    request = ctx.request()
+    from changuito.proxy import CartProxy
+    return lambda: CartProxy(request)
+
+
+@benchmark('middleware')
+def middleware(ctx):
+    from django.http import HttpResponse
+    from changuito.middleware import CartMiddleware
+    request = ctx.request()
+    return lambda: CartMiddleware(lambda r: HttpResponse())(request)
+
+
+@benchmark('add_item_new')
+def add_item_new(ctx):
+    proxy = ctx.new_proxy()
+    product = ctx.product()
+    return lambda: proxy.add_item(product, Decimal('9.99'))
+
+
+@benchmark('add_item_existing')
+def add_item_existing(ctx):
+    proxy = ctx.new_proxy()
+    product = ctx.product()
+    proxy.add_item(product, Decimal('9.99'))
+    return lambda: proxy.add_item(product, Decimal('9.99'))
+
+
+@benchmark('add_items')
+def add_items(ctx):
+    proxy = ctx.new_proxy()
+    lines = ctx.new_lines()
+    return lambda: proxy.add_items(lines)
+
+
+@benchmark('iteration')
+def iteration(ctx):
+    proxy = ctx.filled_proxy()
+    proxy._changed()
+    return lambda: [item.content_object for item in proxy]
+
+
+@benchmark('totals')
+def totals(ctx):
+    proxy = ctx.filled_proxy()
+    return proxy.summary
+
+
+@benchmark('clear_items')
+def clear_items(ctx):
+    return ctx.filled_proxy().clear_items
+
+
+@benchmark('checkout')
+def checkout(ctx):
+    return ctx.filled_proxy().checkout
+
+
+def run(ctx, names, repeat):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    results = OrderedDict()
+    for name in names:
+        timings, queries = [], []
+        for _ in range(repeat):
+            operation = BENCHMARKS[name](ctx)
+            with CaptureQueriesContext(connection) as captured:
+                start = time.time()
+                operation()
+                timings.append(time.time() - start)
+            queries.append(len(captured))
+        timings.sort()
+        results[name] = OrderedDict([
+            ('queries', max(queries)),
+            ('mean_ms', sum(timings) / len(timings) * 1000),
+            ('min_ms', timings[0] * 1000),
+            ('p95_ms', timings[int(len(timings) * 0.95) - 1] * 1000
+             if len(timings) > 1 else timings[0] * 1000),
+        ])
+        print('{:<20} {:>4} queries {:>9.3f} ms mean {:>9.3f} ms p95'.format(
+            name, results[name]['queries'], results[name]['mean_ms'],
+            results[name]['p95_ms']))
+    return results
+
+
+def check_budgets(results, budgets):
+    failures = []
+    for name, budget in budgets.items():
+        if name in results and results[name]['queries'] > budget:
+            failures.append('{}: {} queries, budget is {}'.format(
+                name, results[name]['queries'], budget))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--carts-per-user', type=int, default=10,
+                        help='Historical carts per user')
+    parser.add_argument('--items-per-cart', type=int, default=5)
+    parser.add_argument('--content-types', type=int, default=3,
+                        help='Number of product models, up to 3')
+    parser.add_argument('--products-per-type', type=int, default=200)
+    parser.add_argument('--lines', type=int, default=50,
+                        help='Lines of the carts used by bulk operations')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--items-fk', action='store_true',
+                        help='Use the CART_ITEMS_FK schema')
+    parser.add_argument('--denormalized-totals', action='store_true')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        help='Run only these benchmarks')
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument('--budgets',
+                        help='JSON file mapping benchmarks to their maximum '
+                             'number of queries')
+    args = parser.parse_args(argv)
+
+    database = os.environ.get('CHANGUITO_BENCHMARK_DB')
+    if database:
+        database = json.loads(database)
+    else:
+        database = {'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': os.path.join(tempfile.mkdtemp(),
+                                         'changuito.sqlite3')}
+    configure(database, CART_ITEMS_FK=args.items_fk,
+              CART_DENORMALIZED_TOTALS=args.denormalized_totals)
+
+    from django.core.management import call_command
+    from django.db import connection
+
+    random.seed(0)
+    call_command('migrate', verbosity=0)
+    ctx = Context(*seed(args.users, args.carts_per_user, args.items_per_cart,
+                        args.content_types, args.products_per_type),
+                  lines=args.lines)
+    results = run(ctx, args.only or list(BENCHMARKS), args.repeat)
+
+    report = OrderedDict([
+        ('config', OrderedDict(sorted(vars(args).items()))),
+        ('database', connection.vendor),
+        ('results', results),
+    ])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.budgets:
+        with open(args.budgets) as budgets:
+            failures = check_budgets(results, json.load(budgets))
+        for failure in failures:
+            print('Over budget: {}'.format(failure))
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
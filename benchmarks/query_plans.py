@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Query plans and timings of the cart lookups issued by ``CartProxy`` without
+and with the indexes of the cart models (see ``0004_cart_indexes``).
+
+    python -m benchmarks.query_plans --users 2000 --carts-per-user 20
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import os
+import random
+import tempfile
+import timeit
+
+from benchmarks import configure
+from benchmarks.seed import seed
+
+
+def queries(user_ids, cart_ids, products):
+    from changuito.models import Item
+    from changuito.proxy import Cart
+
+    user_id = random.choice(user_ids)
+    cart_id = random.choice(cart_ids)
+    ct_id, object_id = random.choice(products)
+    return [
+        ('last open cart of a user', lambda: Cart.objects.filter(
+            user_id=user_id, checked_out=False).order_by('-creation_date')[:1]),
+        ('anonymous cart', lambda: Cart.objects.filter(
+            id=cart_id, checked_out=False)),
+        ('item of a cart', lambda: Item.objects.filter(
+            cart=cart_id, content_type_id=ct_id, object_id=object_id)),
+        ('open lines of a product', lambda: Item.objects.filter(
+            content_type_id=ct_id, object_id=object_id,
+            cart__checked_out=False)),
+    ]
+
+
+def measure(label, user_ids, cart_ids, products, repeat):
+    print('== {}'.format(label))
+    for name, queryset in queries(user_ids, cart_ids, products):
+        print('-- {}'.format(name))
+        print(queryset().explain())
+        seconds = min(timeit.repeat(lambda: list(queryset()),
+                                    number=repeat, repeat=3))
+        print('{:.3f} ms per query\n'.format(seconds / repeat * 1000))
+
+
+def indexes():
+    from changuito.models import Item
+    from changuito.proxy import Cart
+
+    return [(model, index) for model in (Cart, Item)
+            for index in model._meta.indexes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--carts-per-user', type=int, default=20)
+    parser.add_argument('--items-per-cart', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'changuito.sqlite3')
+    configure({'ENGINE': 'django.db.backends.sqlite3', 'NAME': path})
+
+    from django.core.management import call_command
+    from django.db import connection
+
+    call_command('migrate', verbosity=0)
+    ids = seed(args.users, args.carts_per_user, args.items_per_cart)
+    with connection.schema_editor() as editor:
+        for model, index in indexes():
+            editor.remove_index(model, index)
+    connection.cursor().execute('ANALYZE')
+    measure('without indexes', *ids, repeat=args.repeat)
+    with connection.schema_editor() as editor:
+        for model, index in indexes():
+            editor.add_index(model, index)
+    connection.cursor().execute('ANALYZE')
+    measure('with indexes', *ids, repeat=args.repeat)
+
+
+if __name__ == '__main__':
+    main()
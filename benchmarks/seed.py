@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import random
+from datetime import datetime, timedelta
+
+PRODUCT_MODELS = ('auth.User', 'auth.Group', 'sites.Site')
+PRODUCT_FIELDS = {
+    'auth.User': lambda name: {'username': name},
+    'auth.Group': lambda name: {'name': name},
+    'sites.Site': lambda name: {'name': name,
+                                'domain': '{}.example.com'.format(name)},
+}
+
+
+def seed(users, carts_per_user, items_per_cart, content_types=1,
+         products_per_type=100):
+    """
+    Fill the database with ``users`` users with ``carts_per_user`` carts each
+    (all checked out but the last one) of ``items_per_cart`` items, whose
+    products are spread over ``content_types`` models.
+
+    Returns the user ids, the cart ids and the products as a list of
+    ``(content_type_id, object_id)`` keys.
+    """
+    from django.apps import apps
+    from django.contrib.auth.models import User
+
+    from changuito.models import Item, items_fk
+    from changuito.products import get_content_type_id
+    from changuito.proxy import Cart
+
+    batch_size = 500
+    User.objects.bulk_create([User(username='user_{}'.format(i))
+                              for i in range(users)], batch_size=batch_size)
+    user_ids = list(User.objects.values_list('id', flat=True))
+
+    products = []
+    for label in PRODUCT_MODELS[:content_types]:
+        model = apps.get_model(label)
+        model.objects.bulk_create(
+            [model(**PRODUCT_FIELDS[label]('product-{}'.format(i)))
+             for i in range(products_per_type)], batch_size=batch_size)
+        ct_id = get_content_type_id(model)
+        products.extend((ct_id, pk) for pk in model.objects.order_by('-pk')
+                        .values_list('pk', flat=True)[:products_per_type])
+
+    start = datetime(2015, 1, 1)
+    carts = []
+    for user_id in user_ids:
+        for n in range(carts_per_user):
+            carts.append(Cart(user_id=user_id,
+                              checked_out=n < carts_per_user - 1,
+                              creation_date=start + timedelta(hours=len(carts))))
+    Cart.objects.bulk_create(carts, batch_size=batch_size)
+    cart_ids = list(Cart.objects.order_by('id').values_list('id', flat=True))
+
+    items = []
+    for cart_id in cart_ids:
+        for ct_id, object_id in random.sample(products, items_per_cart):
+            item = Item(content_type_id=ct_id, object_id=object_id,
+                        quantity=random.randint(1, 5), unit_price='9.99')
+            if items_fk:
+                item.cart_id = cart_id
+            items.append(item)
+    Item.objects.bulk_create(items, batch_size=batch_size)
+    if not items_fk:
+        through = Cart.items.through
+        item_ids = list(Item.objects.order_by('id').values_list('id', flat=True))
+        through.objects.bulk_create(
+            [through(cart_id=cart_ids[i // items_per_cart], item_id=item_id)
+             for i, item_id in enumerate(item_ids)], batch_size=batch_size)
+    return user_ids, cart_ids, products
@@ -5,7 +5,7 @@ from __future__ import absolute_import, unicode_literals
 from django.conf import settings
 from django.contrib import admin
 
-from .models import Item
+from .models import ArchivedCart, Item
 
 try:
     cart_model = settings.CART_MODEL
@@ -28,3 +28,11 @@ class ItemAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Item, ItemAdmin)
+
+
+class ArchivedCartAdmin(admin.ModelAdmin):
+    list_display = ('cart_id', 'user', 'creation_date', 'stored_total_price')
+    readonly_fields = ('lines',)
+
+
+admin.site.register(ArchivedCart, ArchivedCartAdmin)
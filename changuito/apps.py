@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from django.apps import AppConfig
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_migrate
+
+
+class ChanguitoConfig(AppConfig):
+    name = 'changuito'
+
+    def ready(self):
+        from .products import clear_content_types
+        from .proxy import merge_anonymous_cart
+        from .storage import promote_anonymous_cart
+        post_migrate.connect(clear_content_types,
+                             dispatch_uid='changuito_clear_content_types')
+        user_logged_in.connect(promote_anonymous_cart,
+                               dispatch_uid='changuito_promote_anonymous_cart')
+        user_logged_in.connect(merge_anonymous_cart,
+                               dispatch_uid='changuito_merge_anonymous_cart')
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Cart proxies usable from async views.
+
+Django's ORM and sessions are synchronous in the versions supported here, so
+every ``a``-prefixed method runs its sync counterpart, queries included, in a
+single ``sync_to_async`` call instead of one per query.
+"""
+
+from asgiref.sync import sync_to_async
+
+from .proxy import CartProxy
+
+
+def _async(name):
+    async def method(self, *args, **kwargs):
+        return await sync_to_async(getattr(self, name))(*args, **kwargs)
+    method.__name__ = 'a' + name
+    method.__doc__ = 'Async version of ``{}``.'.format(name)
+    return method
+
+
+class AsyncCartMixin(object):
+    """
+    Async methods for a ``CartProxy`` class, e.g. ``await cart.aadd_item(
+    product, price)`` or ``async for item in cart``.
+    """
+
+    async def aget_cart(self):
+        """The cart, looked up (and created) on first use."""
+        return await sync_to_async(lambda: self.cart)()
+
+    aadd_item = _async('add_item')
+    aadd_items = _async('add_items')
+    aset_quantities = _async('set_quantities')
+    aremove_item = _async('remove_item')
+    aget_item = _async('get_item')
+    aclear_items = _async('clear_items')
+    aupdate_item_quantity = _async('update_item_quantity')
+    ais_empty = _async('is_empty')
+    asummary = _async('summary')
+    atotal_price = _async('total_price')
+    atotal_quantity = _async('total_quantity')
+    aitems_with_products = _async('items_with_products')
+    asnapshot = _async('snapshot')
+    acheckout = _async('checkout')
+
+    async def __aiter__(self):
+        for item in await self.aitems_with_products():
+            yield item
+
+
+class AsyncCartProxy(AsyncCartMixin, CartProxy):
+    pass
+
+
+_async_classes = {CartProxy: AsyncCartProxy}
+
+
+def async_proxy_class(proxy_class):
+    """``proxy_class`` with the async methods of ``AsyncCartMixin``."""
+    if issubclass(proxy_class, AsyncCartMixin):
+        return proxy_class
+    if proxy_class not in _async_classes:
+        _async_classes[proxy_class] = type(
+            str('Async' + proxy_class.__name__),
+            (AsyncCartMixin, proxy_class), {})
+    return _async_classes[proxy_class]
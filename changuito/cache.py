@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+def get_snapshot_cache():
+    """
+    The cache of CART_SNAPSHOT_CACHE (an alias of ``CACHES``), ``None`` when
+    cart snapshots are not cached across requests.
+    """
+    alias = getattr(settings, 'CART_SNAPSHOT_CACHE', None)
+    if alias:
+        return caches[alias]
+
+
+def version_key(cart_id):
+    return 'changuito:version:{}'.format(cart_id)
+
+
+def snapshot_key(cart_id, version):
+    return 'changuito:snapshot:{}:{}'.format(cart_id, version)
+
+
+def get_version(cache, cart_id):
+    version = cache.get(version_key(cart_id))
+    if version is None:
+        # Start from the clock rather than 0, so that an evicted counter
+        # can't be reused with an old snapshot still in the cache
+        cache.add(version_key(cart_id), int(time.time() * 1000), None)
+        version = cache.get(version_key(cart_id))
+    return version
+
+
+def _bump(cache, cart_ids):
+    for cart_id in cart_ids:
+        try:
+            cache.incr(version_key(cart_id))
+        except ValueError:
+            # Unknown counter, so there is no snapshot to invalidate
+            pass
+
+
+def bump_versions(cart_ids, using=None):
+    """
+    Invalidate the cached snapshots of ``cart_ids``. Needed by code that
+    modifies carts without going through ``CartProxy``.
+
+    Inside a transaction of the ``using`` database the versions are bumped
+    again once it commits, so that a snapshot read meanwhile from the old
+    rows is discarded too.
+    """
+    cache = get_snapshot_cache()
+    cart_ids = [cart_id for cart_id in cart_ids if cart_id is not None]
+    if cache is None or not cart_ids:
+        return
+    _bump(cache, cart_ids)
+    using = using or DEFAULT_DB_ALIAS
+    if connections[using].in_atomic_block:
+        transaction.on_commit(lambda: _bump(cache, cart_ids), using=using)
+
+
+def get_snapshot(cache, cart_id):
+    """``(version, snapshot)`` of a cart, ``snapshot`` is ``None`` if missing."""
+    version = get_version(cache, cart_id)
+    return version, cache.get(snapshot_key(cart_id, version))
+
+
+def set_snapshot(cache, cart_id, version, snapshot):
+    cache.set(snapshot_key(cart_id, version), snapshot,
+              getattr(settings, 'CART_SNAPSHOT_TIMEOUT', 300))
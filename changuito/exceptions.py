@@ -7,5 +7,13 @@ class ItemDoesNotExist(Exception):
     pass
 
 
+class ItemIsDetached(ItemDoesNotExist):
+    pass
+
+
 class CartDoesNotExist(Exception):
     pass
+
+
+class CartAlreadyCheckedOut(Exception):
+    pass
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of carts and their lines, e.g. for analytics.
+
+    with open('carts.jsonl', 'w') as output:
+        write_jsonl(export_lines(since=date(2020, 1, 1), products=True),
+                    output)
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import csv
+import json
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import get_cart_model
+from .products import get_product_model
+
+# Cart and item fields of every exported line
+FIELDS = OrderedDict([
+    ('cart_id', 'pk'),
+    ('user_id', 'user_id'),
+    ('creation_date', 'creation_date'),
+    ('checked_out', 'checked_out'),
+    ('item_id', 'items__pk'),
+    ('content_type_id', 'items__content_type_id'),
+    ('object_id', 'items__object_id'),
+    ('quantity', 'items__quantity'),
+    ('unit_price', 'items__unit_price'),
+])
+
+
+def _day_start(day):
+    start = datetime.combine(day, time.min)
+    if settings.USE_TZ:
+        start = timezone.make_aware(start)
+    return start
+
+
+def export_lines(carts=None, since=None, until=None, checked_out=None,
+                 products=False, chunk_size=2000):
+    """
+    Generator of one ``OrderedDict`` per item of the carts, with the fields
+    of ``FIELDS``, ordered by cart. Carts without items give one line with
+    empty item fields.
+
+    ``carts`` is a queryset of carts, all of them by default, which is
+    filtered by creation date (``since`` and ``until`` are inclusive dates)
+    and by ``checked_out`` unless it is ``None``. With ``products`` the
+    lines also have the ``product`` model label of their content type.
+
+    Rows are streamed with ``QuerySet.iterator`` from a single query, which
+    uses a server-side cursor where the database supports it, so memory use
+    doesn't depend on the number of carts.
+    """
+    if carts is None:
+        carts = get_cart_model()._default_manager.all()
+    if since is not None:
+        carts = carts.filter(creation_date__gte=_day_start(since))
+    if until is not None:
+        carts = carts.filter(
+            creation_date__lt=_day_start(until + timedelta(days=1)))
+    if checked_out is not None:
+        carts = carts.filter(checked_out=checked_out)
+    rows = carts.order_by('pk', 'items__pk').values_list(*FIELDS.values())
+    for row in rows.iterator(chunk_size=chunk_size):
+        line = OrderedDict(zip(FIELDS, row))
+        if products:
+            model = (get_product_model(line['content_type_id'])
+                     if line['content_type_id'] else None)
+            line['product'] = model._meta.label_lower if model else None
+        yield line
+
+
+def write_csv(lines, output):
+    """Write the exported ``lines`` to the ``output`` file as CSV."""
+    writer = None
+    for line in lines:
+        if writer is None:
+            writer = csv.DictWriter(output, fieldnames=list(line))
+            writer.writeheader()
+        writer.writerow(line)
+
+
+def write_jsonl(lines, output):
+    """Write the exported ``lines`` to the ``output`` file as JSON Lines."""
+    for line in lines:
+        output.write(json.dumps(line, cls=DjangoJSONEncoder) + '\n')
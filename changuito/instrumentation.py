@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from .signals import cart_operation
+
+_sinks = {}
+
+
+def is_enabled():
+    return getattr(settings, 'CART_INSTRUMENTATION', False)
+
+
+def get_sink():
+    """The CART_METRICS_SINK instance, created once per process."""
+    path = getattr(settings, 'CART_METRICS_SINK',
+                   'changuito.instrumentation.MetricsSink')
+    if path not in _sinks:
+        _sinks[path] = import_string(path)()
+    return _sinks[path]
+
+
+class MetricsSink(object):
+    """Receives the metrics of every cart operation. Does nothing."""
+
+    def record(self, operation, queries, db_time, wall_time):
+        pass
+
+
+class InMemorySink(MetricsSink):
+    """
+    Keeps the last ``max_samples`` measures of each operation in memory and
+    aggregates them on demand.
+    """
+    max_samples = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, operation, queries, db_time, wall_time):
+        with self._lock:
+            if operation not in self._samples:
+                self._samples[operation] = deque(maxlen=self.max_samples)
+            self._samples[operation].append((queries, db_time, wall_time))
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+
+    @staticmethod
+    def _percentile(values, percent):
+        # Nearest rank over sorted values
+        index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+        return values[index]
+
+    def stats(self, operation):
+        with self._lock:
+            samples = list(self._samples.get(operation, ()))
+        if not samples:
+            return None
+        stats = {'count': len(samples)}
+        for position, name in enumerate(('queries', 'db_time', 'wall_time')):
+            values = sorted(sample[position] for sample in samples)
+            for percent in (50, 95, 99):
+                stats['{}_p{}'.format(name, percent)] = \
+                    self._percentile(values, percent)
+        return stats
+
+    def summary(self):
+        with self._lock:
+            operations = list(self._samples)
+        return dict((operation, self.stats(operation))
+                    for operation in operations)
+
+
+class _QueryCounter(object):
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.time() - start
+
+
+class measure(object):
+    """
+    Context manager measuring the queries, database time and wall time of a
+    cart operation. The measure goes to the metrics sink, the
+    ``cart_operation`` signal and the ``metrics`` of ``proxy`` if given.
+    """
+
+    def __init__(self, operation, proxy=None):
+        self.operation = operation
+        self.proxy = proxy
+        self.enabled = is_enabled()
+
+    def __enter__(self):
+        if self.enabled:
+            self.counter = _QueryCounter()
+            self.wrappers = [connection.execute_wrapper(self.counter)
+                             for connection in connections.all()]
+            for wrapper in self.wrappers:
+                wrapper.__enter__()
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+        wall_time = time.time() - self.start
+        for wrapper in reversed(self.wrappers):
+            wrapper.__exit__(exc_type, exc_value, traceback)
+        queries, db_time = self.counter.queries, self.counter.db_time
+        get_sink().record(self.operation, queries, db_time, wall_time)
+        if self.proxy is not None:
+            self.proxy.metrics.append(
+                (self.operation, queries, db_time, wall_time))
+        cart_operation.send(sender=self.__class__, operation=self.operation,
+                            queries=queries, db_time=db_time,
+                            wall_time=wall_time, proxy=self.proxy)
+
+
+def instrumented(operation):
+    """Measure a ``CartProxy`` method as ``operation``."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not is_enabled():
+                return method(self, *args, **kwargs)
+            with measure(operation, self):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summarize(metrics):
+    """Totals per operation of a list of ``(operation, queries, db_time,
+    wall_time)`` measures, as kept by ``CartProxy.metrics``."""
+    summary = {}
+    for operation, queries, db_time, wall_time in metrics:
+        totals = summary.setdefault(operation, {
+            'count': 0, 'queries': 0, 'db_time': 0.0, 'wall_time': 0.0})
+        totals['count'] += 1
+        totals['queries'] += queries
+        totals['db_time'] += db_time
+        totals['wall_time'] += wall_time
+    return summary
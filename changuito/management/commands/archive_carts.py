@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from changuito.models import archive_carts, get_cart_model
+
+
+class Command(BaseCommand):
+    help = ('Move checked-out carts older than a given age to the archived '
+            'carts table, in small batches that can run against a live '
+            'database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=0,
+                            help='Minimum age of the carts, in days')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Carts archived per transaction')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between batches')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume after this cart id, as reported '
+                                 'by an interrupted run')
+        parser.add_argument('--skip-signals', action='store_true',
+                            help='Do not send the delete signals of each '
+                                 'item')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the carts that would be '
+                                 'archived')
+
+    def handle(self, *args, **options):
+        cart_model = get_cart_model()
+        carts = cart_model._default_manager.filter(
+            checked_out=True,
+            creation_date__lt=timezone.now() - timedelta(days=options['days']))
+        if options['dry_run']:
+            self.stdout.write('{} carts would be archived'.format(
+                carts.filter(pk__gt=options['start_after']).count()))
+            return
+
+        last_id = options['start_after']
+        archived = 0
+        started = time.time()
+        while True:
+            # Keyset pagination, so every batch is an index range scan
+            ids = list(carts.filter(pk__gt=last_id).order_by('pk')
+                       .values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            archived += archive_carts(
+                cart_model._default_manager.filter(pk__in=ids),
+                send_signals=not options['skip_signals'])
+            last_id = ids[-1]
+            elapsed = time.time() - started
+            self.stdout.write(
+                '{} carts archived ({:.0f} carts/s), last id {}'.format(
+                    archived, archived / elapsed if elapsed else archived,
+                    last_id))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write('Done, {} carts archived'.format(archived))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import argparse
+import io
+
+from django.core.management.base import BaseCommand
+from django.utils.dateparse import parse_date
+
+from changuito.export import export_lines, write_csv, write_jsonl
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+
+def _date(value):
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise argparse.ArgumentTypeError(
+            '{!r} is not a YYYY-MM-DD date'.format(value))
+    return day
+
+
+class Command(BaseCommand):
+    help = ('Stream carts and their items as CSV or JSON Lines, one line per '
+            'item, in constant memory')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(WRITERS),
+                            default='csv')
+        parser.add_argument('--output',
+                            help='File to write to, standard output if unset')
+        parser.add_argument('--since', type=_date,
+                            help='Only carts created on or after this date')
+        parser.add_argument('--until', type=_date,
+                            help='Only carts created on or before this date')
+        state = parser.add_mutually_exclusive_group()
+        state.add_argument('--checked-out', dest='checked_out',
+                           action='store_true', default=None,
+                           help='Only checked out carts')
+        state.add_argument('--open', dest='checked_out',
+                           action='store_false',
+                           help='Only carts not checked out')
+        parser.add_argument('--products', action='store_true',
+                            help='Add the model label of the products')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Rows fetched from the database at a time')
+
+    def handle(self, *args, **options):
+        lines = export_lines(since=options['since'], until=options['until'],
+                             checked_out=options['checked_out'],
+                             products=options['products'],
+                             chunk_size=options['chunk_size'])
+        write = WRITERS[options['format']]
+        if options['output']:
+            with io.open(options['output'], 'w', newline='') as output:
+                write(lines, output)
+        else:
+            write(lines, self.stdout)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.utils import timezone
+
+from changuito.cache import bump_versions
+from changuito.models import delete_carts, get_cart_model
+
+
+class Command(BaseCommand):
+    help = ('Delete abandoned carts, not checked out and older than a given '
+            'age, in small batches that can run against a live database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Minimum age of the carts, in days')
+        parser.add_argument('--anonymous-only', action='store_true',
+                            help='Only delete carts without user')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Carts deleted per transaction')
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to wait between batches')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume after this cart id, as reported '
+                                 'by an interrupted run')
+        parser.add_argument('--skip-signals', action='store_true',
+                            help='Do not send the delete signals of each '
+                                 'item')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the carts that would be deleted')
+
+    def handle(self, *args, **options):
+        cart_model = get_cart_model()
+        carts = cart_model._default_manager.filter(
+            checked_out=False,
+            creation_date__lt=timezone.now() - timedelta(days=options['days']))
+        if options['anonymous_only']:
+            carts = carts.filter(user=None)
+        if options['dry_run']:
+            self.stdout.write('{} carts would be deleted'.format(
+                carts.filter(pk__gt=options['start_after']).count()))
+            return
+
+        db = router.db_for_write(cart_model)
+        last_id = options['start_after']
+        deleted_carts = deleted_rows = 0
+        started = time.time()
+        while True:
+            # Keyset pagination, so every batch is an index range scan
+            ids = list(carts.filter(pk__gt=last_id).order_by('pk')
+                       .values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+            with transaction.atomic(using=db):
+                # The conditions are checked again, and the carts locked, in
+                # the transaction of the delete: carts checked out since the
+                # select are kept
+                batch = carts.filter(pk__in=ids)
+                ids = list(batch.select_for_update()
+                           .values_list('pk', flat=True))
+                rows = delete_carts(batch,
+                                    send_signals=not options['skip_signals'])
+            bump_versions(ids)
+            deleted_carts += len(ids)
+            deleted_rows += rows
+            elapsed = time.time() - started
+            self.stdout.write(
+                '{} carts deleted ({} rows, {:.0f} rows/s), last id {}'.format(
+                    deleted_carts, deleted_rows,
+                    deleted_rows / elapsed if elapsed else deleted_rows,
+                    last_id))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        self.stdout.write('Done, {} carts deleted'.format(deleted_carts))
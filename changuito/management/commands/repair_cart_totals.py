@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from changuito.cache import bump_versions
+from changuito.models import (Item, get_cart_model, line_total,
+                              recompute_totals)
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored totals of carts and repair the drifted ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of carts checked per query')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the carts that drifted')
+
+    def handle(self, *args, **options):
+        cart_model = get_cart_model()
+        batch_size = options['batch_size']
+        checked = repaired = 0
+        last_id = 0
+        while True:
+            carts = list(cart_model._default_manager
+                         .filter(pk__gt=last_id).order_by('pk')
+                         .only('stored_total_price', 'stored_total_quantity',
+                               'item_count')[:batch_size])
+            if not carts:
+                break
+            last_id = carts[-1].pk
+            checked += len(carts)
+            drifted = self.drifted_carts(carts)
+            repaired += len(drifted)
+            if drifted and not options['dry_run']:
+                # Computed again by the UPDATE, the items may have changed
+                # since they were read
+                ids = [cart.pk for cart in drifted]
+                recompute_totals(ids)
+                bump_versions(ids)
+        self.stdout.write('{} carts checked, {} {}'.format(
+            checked, repaired, 'drifted' if options['dry_run'] else 'repaired'))
+
+    @staticmethod
+    def drifted_carts(carts):
+        totals = dict(
+            (row['cart'], row) for row in Item.objects
+            .filter(cart__in=carts).values('cart')
+            .annotate(price=Sum(line_total()), quantity=Sum('quantity'),
+                      count=Count('id'))
+            .order_by())
+        drifted = []
+        for cart in carts:
+            row = totals.get(cart.pk, {})
+            price = row.get('price') or Decimal('0')
+            quantity = row.get('quantity') or Decimal('0')
+            count = row.get('count', 0)
+            if (cart.stored_total_price, cart.stored_total_quantity,
+                    cart.item_count) != (price, quantity, count):
+                cart.stored_total_price = price
+                cart.stored_total_quantity = quantity
+                cart.item_count = count
+                drifted.append(cart)
+        return drifted
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import csv
+from decimal import Decimal, InvalidOperation
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from changuito.models import reprice_products
+from changuito.products import ProductKey, get_content_type_id
+
+
+class Command(BaseCommand):
+    help = ('Set the unit price of products in every cart not checked out, '
+            'with set-based updates')
+
+    def add_arguments(self, parser):
+        parser.add_argument('product', nargs='?',
+                            help='Model of the product, as app_label.model')
+        parser.add_argument('object_id', nargs='?', type=int,
+                            help='Id of the product')
+        parser.add_argument('price', nargs='?', help='New unit price')
+        parser.add_argument('--prices',
+                            help='CSV file of app_label.model,object_id,price '
+                                 'rows to reprice several products at once')
+
+    def handle(self, *args, **options):
+        rows = []
+        if options['product'] is not None:
+            if options['price'] is None:
+                raise CommandError('Give the product, its id and its price')
+            rows.append((options['product'], options['object_id'],
+                         options['price']))
+        if options['prices']:
+            with open(options['prices']) as prices:
+                rows.extend(row for row in csv.reader(prices) if row)
+        if not rows:
+            raise CommandError('Give a product or --prices')
+        prices = dict(self.parse(*row) for row in rows)
+        self.stdout.write('{} carts repriced'.format(reprice_products(prices)))
+
+    @staticmethod
+    def parse(label, object_id, price):
+        try:
+            model = apps.get_model(label)
+        except (LookupError, ValueError):
+            raise CommandError('Unknown product model {}'.format(label))
+        try:
+            price = Decimal(price)
+        except InvalidOperation:
+            raise CommandError('Invalid price {}'.format(price))
+        return ProductKey(get_content_type_id(model), int(object_id)), price
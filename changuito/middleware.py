@@ -2,14 +2,106 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from .proxy import CART_ID, CartProxy
+import asyncio
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 
-class CartMiddleware(object):
+from .async_proxy import async_proxy_class
+from .instrumentation import measure
+from .proxy import cart_proxy_class
+from .storage import update_cart_cookie
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+
+def _matches(path, rules):
+    for rule in rules:
+        if isinstance(rule, str):
+            if path.startswith(rule):
+                return True
+        elif rule.match(path):
+            return True
+    return False
+
+
+def handles_path(path):
+    """
+    Whether the cart middlewares set ``request.cart`` for ``path``, according
+    to CART_MIDDLEWARE_INCLUDE and CART_MIDDLEWARE_EXCLUDE. Their rules are
+    path prefixes (strings) or compiled regular expressions.
+    """
+    include = getattr(settings, 'CART_MIDDLEWARE_INCLUDE', None)
+    if include and not _matches(path, include):
+        return False
+    return not _matches(path,
+                        getattr(settings, 'CART_MIDDLEWARE_EXCLUDE', ()))
+
+
+class CartMiddleware(MiddlewareMixin):
+    """
+    Sets ``request.cart`` to the proxy of the cart of the request, except for
+    paths excluded by ``handles_path``, and writes the cookie of cookie carts.
+    The request body is never read.
+    """
 
     def process_request(self, request):
+        if not handles_path(request.path_info):
+            return
+        with measure('middleware') as measured:
+            proxy_class = cart_proxy_class(request)
+            if getattr(settings, 'CART_LAZY', True):
+                # The cart is resolved and stored in the session on first use
+                request.cart = proxy_class(request, lazy=True)
+            else:
+                request.cart = proxy_class(request)
+                request.cart.remember_cart()
+            measured.proxy = request.cart
+
+    def process_response(self, request, response):
+        update_cart_cookie(request, response)
+        return response
+
+
+class AsyncCartMiddleware(object):
+    """
+    ``MIDDLEWARE`` entry setting ``request.cart`` to a lazy proxy with the
+    async methods of ``AsyncCartMixin``, e.g. ``await request.cart.aadd_item(
+    ...)``. It runs natively under both WSGI and ASGI, and does no database
+    work unless CART_ANONYMOUS_PROXY needs to know if the user is anonymous.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Tells Django to await this middleware, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def set_cart(self, request):
+        proxy_class = async_proxy_class(cart_proxy_class(request))
+        request.cart = proxy_class(request, lazy=True)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if handles_path(request.path_info):
+            self.set_cart(request)
+        response = self.get_response(request)
+        update_cart_cookie(request, response)
+        return response
 
-        # You can't modify the session if the requested view has csrf protection
-        if 'csrfmiddlewaretoken' not in request.POST:
-            request.cart = CartProxy(request)
-            request.session[CART_ID] = request.cart.cart.id
+    async def __acall__(self, request):
+        if handles_path(request.path_info):
+            if getattr(settings, 'CART_ANONYMOUS_PROXY', None):
+                # Loading request.user may query the database
+                await sync_to_async(self.set_cart)(request)
+            else:
+                self.set_cart(request)
+        response = await self.get_response(request)
+        update_cart_cookie(request, response)
+        return response
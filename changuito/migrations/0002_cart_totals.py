@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changuito', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='item count'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stored_total_price',
+            field=models.DecimalField(decimal_places=5, default=Decimal('0'), max_digits=24, verbose_name='total price'),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='stored_total_quantity',
+            field=models.DecimalField(decimal_places=3, default=Decimal('0'), max_digits=18, verbose_name='total quantity'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, OuterRef, Subquery, Sum
+
+
+def link_items_to_carts(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Cart = apps.get_model('changuito', 'Cart')
+    Item = apps.get_model('changuito', 'Item')
+    through = Cart._meta.get_field('items').remote_field.through
+    Item.objects.using(db).update(cart_id=Subquery(
+        through.objects.using(db).filter(item_id=OuterRef('pk'))
+        .order_by('cart_id').values('cart_id')[:1]))
+
+    # Fold duplicated lines of the same product before adding the unique key
+    duplicates = (Item.objects.using(db).exclude(cart=None)
+                  .values('cart_id', 'content_type_id', 'object_id')
+                  .annotate(lines=Count('id'), first=Min('id'),
+                            total=Sum('quantity'))
+                  .filter(lines__gt=1).order_by())
+    for row in duplicates:
+        Item.objects.using(db).filter(pk=row['first']).update(quantity=row['total'])
+        Item.objects.using(db).filter(
+            cart_id=row['cart_id'], content_type_id=row['content_type_id'],
+            object_id=row['object_id']).exclude(pk=row['first']).delete()
+
+
+def link_carts_to_items(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Cart = apps.get_model('changuito', 'Cart')
+    Item = apps.get_model('changuito', 'Item')
+    through = Cart._meta.get_field('items').remote_field.through
+    through.objects.using(db).bulk_create(
+        [through(cart_id=cart_id, item_id=item_id) for item_id, cart_id in
+         Item.objects.using(db).exclude(cart=None).values_list('id', 'cart_id')],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changuito', '0002_cart_totals'),
+    ]
+
+    # Only applied when CART_ITEMS_FK is enabled for the default cart model,
+    # custom cart models get the foreign key with their own migrations
+    operations = []
+    if getattr(settings, 'CART_ITEMS_FK', False) and not getattr(settings, 'CART_MODEL', None):
+        operations = [
+            # Free the ``cart`` accessor of Item for the new foreign key
+            migrations.AlterField(
+                model_name='cart',
+                name='items',
+                field=models.ManyToManyField(related_name='legacy_carts', to='changuito.Item', verbose_name='items'),
+            ),
+            migrations.AddField(
+                model_name='item',
+                name='cart',
+                field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='changuito.Cart', verbose_name='cart'),
+            ),
+            migrations.RunPython(link_items_to_carts, link_carts_to_items),
+            migrations.RemoveField(
+                model_name='cart',
+                name='items',
+            ),
+            migrations.AlterField(
+                model_name='item',
+                name='cart',
+                field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='items', to='changuito.Cart', verbose_name='cart'),
+            ),
+            migrations.AlterUniqueTogether(
+                name='item',
+                unique_together={('cart', 'content_type', 'object_id')},
+            ),
+        ]
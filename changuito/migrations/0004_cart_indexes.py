@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import changuito.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('changuito', '0003_item_cart_fk'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=changuito.models.PartialIndex(condition=models.Q(('checked_out', False)), fallback_fields=['user', 'checked_out', 'creation_date'], fields=['user', 'creation_date'], name='changuito_cart_user_open'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['content_type', 'object_id'], name='changuito_item_product'),
+        ),
+    ]
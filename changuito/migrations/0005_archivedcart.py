@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('changuito', '0004_cart_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cart_id', models.PositiveIntegerField(unique=True, verbose_name='cart id')),
+                ('creation_date', models.DateTimeField(verbose_name='creation date')),
+                ('archive_date', models.DateTimeField(default=datetime.datetime.now, verbose_name='archive date')),
+                ('stored_total_price', models.DecimalField(decimal_places=5, max_digits=24, verbose_name='total price')),
+                ('stored_total_quantity', models.DecimalField(decimal_places=3, max_digits=18, verbose_name='total quantity')),
+                ('item_count', models.PositiveIntegerField(verbose_name='item count')),
+                ('lines', models.TextField(verbose_name='lines')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'archived cart',
+                'verbose_name_plural': 'archived carts',
+                'ordering': ('-creation_date',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedcart',
+            index=models.Index(fields=['user', 'creation_date'], name='changuito_archivedcart_user'),
+        ),
+    ]
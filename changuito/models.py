@@ -2,14 +2,24 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import json
 from datetime import datetime as timezone
+from decimal import Decimal
 
+from django.apps import apps
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import (Case, Count, DecimalField, ExpressionWrapper, F,
+                              OuterRef, Q, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce
 from django.utils.translation import ugettext_lazy as _
 
+from .cache import bump_versions
+from .exceptions import ItemIsDetached
+from .products import product_key
+
 try:
     User = settings.AUTH_USER_MODEL
 except AttributeError:
@@ -20,6 +30,249 @@ try:
 except AttributeError:
     cart_model = None
 
+# Items reference their cart with a foreign key instead of the cart having a
+# many to many to its items. The schema depends on it, so it can't change
+# once migrated.
+items_fk = getattr(settings, 'CART_ITEMS_FK', False)
+
+# Below the parameter limit of every backend, SQLite's 999 included
+DELETE_BATCH_SIZE = 900
+REPRICE_BATCH_SIZE = DELETE_BATCH_SIZE // 5
+
+
+class PartialIndex(models.Index):
+    """
+    Index with a ``condition``, made on ``fallback_fields`` without it by
+    databases lacking partial indexes (MySQL, Oracle), where Django would
+    otherwise drop the condition and index the other fields alone.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.fallback_fields = list(kwargs.pop('fallback_fields'))
+        super(PartialIndex, self).__init__(*args, **kwargs)
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.features.supports_partial_indexes:
+            return super(PartialIndex, self).create_sql(
+                model, schema_editor, using, **kwargs)
+        fallback = models.Index(fields=self.fallback_fields, name=self.name,
+                                db_tablespace=self.db_tablespace)
+        return fallback.create_sql(model, schema_editor, using, **kwargs)
+
+    def deconstruct(self):
+        path, args, kwargs = super(PartialIndex, self).deconstruct()
+        kwargs['fallback_fields'] = self.fallback_fields
+        return path, args, kwargs
+
+
+def get_cart_model():
+    if cart_model:
+        return apps.get_model(cart_model)
+    return Cart
+
+
+def uses_denormalized_totals():
+    return getattr(settings, 'CART_DENORMALIZED_TOTALS', False)
+
+
+def line_total():
+    """Expression for the total price of an item row."""
+    return ExpressionWrapper(F('quantity') * F('unit_price'),
+                             output_field=DecimalField(max_digits=24,
+                                                       decimal_places=5))
+
+
+def totals_delta(price=0, quantity=0, count=0):
+    """
+    Keyword arguments for a queryset ``update`` that shifts the stored totals
+    of the matched carts by the given amounts.
+    """
+    return {
+        'stored_total_price': F('stored_total_price') + price,
+        'stored_total_quantity': F('stored_total_quantity') + quantity,
+        'item_count': F('item_count') + count,
+    }
+
+
+def delete_items(carts, send_signals=True):
+    """
+    Delete the items of the ``carts`` queryset, and the rows linking them to
+    their carts, with bulk DELETEs inside one transaction. Returns the number
+    of rows deleted.
+
+    With ``send_signals=False`` the rows are deleted without being loaded, so
+    no ``pre_delete`` or ``post_delete`` signal is sent for each item.
+    """
+    db = router.db_for_write(Item)
+    items = Item.objects.using(db).filter(cart__in=carts)
+    with transaction.atomic(using=db, savepoint=False):
+        if send_signals:
+            return items.delete()[0]
+        if items_fk:
+            return items._raw_delete(db)
+        field = carts.model._meta.get_field('items')
+        links = field.remote_field.through.objects.using(db).filter(
+            **{'{}__in'.format(field.m2m_field_name()): carts})
+        # The links are needed to find the items, so read them first
+        ids = list(items.order_by().values_list('pk', flat=True))
+        return links._raw_delete(db) + delete_item_ids(ids, db, links=False)
+
+
+def delete_item_ids(ids, using, links=True):
+    """
+    Delete the items with the given primary keys, and their links to carts
+    unless ``links`` is false, without loading them or sending signals.
+    """
+    rows = 0
+    for start in range(0, len(ids), DELETE_BATCH_SIZE):
+        batch = ids[start:start + DELETE_BATCH_SIZE]
+        if links and not items_fk:
+            field = get_cart_model()._meta.get_field('items')
+            rows += field.remote_field.through.objects.using(using).filter(
+                **{'{}__in'.format(field.m2m_reverse_field_name()): batch}
+            )._raw_delete(using)
+        rows += Item.objects.using(using).filter(
+            pk__in=batch)._raw_delete(using)
+    return rows
+
+
+def delete_carts(carts, send_signals=True):
+    """
+    Delete the ``carts`` queryset and their items in one transaction, see
+    ``delete_items``. Carts are always deleted through Django's collector so
+    that relations of a custom CART_MODEL cascade. Returns the number of rows
+    deleted.
+    """
+    with transaction.atomic(using=router.db_for_write(carts.model),
+                            savepoint=False):
+        rows = delete_items(carts, send_signals)
+        return rows + carts.delete()[0]
+
+
+def archive_carts(carts, send_signals=True):
+    """
+    Move the checked-out carts of the ``carts`` queryset, and their items, to
+    ``ArchivedCart`` rows in one transaction, with a query for the carts, one
+    for their items, a bulk INSERT and the DELETEs of ``delete_carts``.
+    Returns the number of carts archived.
+    """
+    db = router.db_for_write(carts.model)
+    with transaction.atomic(using=db, savepoint=False):
+        rows = list(carts.using(db).filter(checked_out=True).order_by('pk')
+                    .values_list('pk', 'user_id', 'creation_date'))
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        lines = dict((cart_id, []) for cart_id in ids)
+        for cart_id, pk, ct_id, object_id, quantity, unit_price in (
+                Item.objects.using(db).filter(cart__in=ids).order_by('pk')
+                .values_list('cart', 'pk', 'content_type_id', 'object_id',
+                             'quantity', 'unit_price')):
+            lines[cart_id].append([pk, ct_id, object_id, str(quantity),
+                                   str(unit_price)])
+        ArchivedCart.objects.using(db).bulk_create(
+            ArchivedCart.from_lines(cart_id, user_id, creation_date,
+                                    lines[cart_id])
+            for cart_id, user_id, creation_date in rows)
+        delete_carts(carts.model._default_manager.using(db).filter(
+            pk__in=ids), send_signals)
+    bump_versions(ids, db)
+    return len(ids)
+
+
+def reprice_open_carts(product, price):
+    """
+    Set the unit price of ``product``, a model instance or a ``ProductKey``,
+    in every cart not checked out. Returns the number of carts affected, see
+    ``reprice_products``.
+    """
+    return reprice_products({product: price})
+
+
+def reprice_products(prices):
+    """
+    Set the unit prices of the products of the ``prices`` mapping (of model
+    instances or ``ProductKey``s to prices) in every cart not checked out.
+
+    Lines are found through the ``changuito_item_product`` index and changed
+    with one SELECT of their carts and one UPDATE per content type (and per
+    REPRICE_BATCH_SIZE products), whatever the number of carts. The stored totals of the affected
+    carts are then recomputed with one UPDATE per DELETE_BATCH_SIZE carts
+    when CART_DENORMALIZED_TOTALS is enabled. Returns the number of carts
+    affected, lines already at their new price don't count.
+    """
+    by_ctype = {}
+    for product, price in prices.items():
+        key = product_key(product)
+        by_ctype.setdefault(key.content_type_id, {})[key.object_id] = price
+    db = router.db_for_write(Item)
+    unit_price = Item._meta.get_field('unit_price')
+    cart_ids = set()
+    with transaction.atomic(using=db):
+        for ct_id, object_prices in by_ctype.items():
+            object_prices = sorted(object_prices.items())
+            # An UPDATE takes up to 5 parameters per product
+            for start in range(0, len(object_prices), REPRICE_BATCH_SIZE):
+                batch = object_prices[start:start + REPRICE_BATCH_SIZE]
+                new_price = Case(*[When(object_id=object_id,
+                                        then=Value(price))
+                                   for object_id, price in batch],
+                                 output_field=unit_price)
+                lines = Item.objects.using(db).filter(
+                    content_type_id=ct_id,
+                    object_id__in=[object_id for object_id, _ in batch],
+                    cart__checked_out=False).exclude(unit_price=new_price)
+                carts = set(lines.order_by().values_list('cart', flat=True))
+                if carts:
+                    lines.update(unit_price=new_price)
+                    cart_ids |= carts
+        if cart_ids and uses_denormalized_totals():
+            recompute_totals(cart_ids, db)
+        touch_carts(cart_ids, db)
+    return len(cart_ids)
+
+
+def touch_carts(cart_ids, using=None):
+    """
+    Bump the ``version`` of the carts ``cart_ids``, with one UPDATE per
+    DELETE_BATCH_SIZE carts, and invalidate their cached snapshots (see
+    ``bump_versions``). Needed by code that modifies carts without going
+    through ``CartProxy``.
+    """
+    cart_ids = sorted(set(cart_id for cart_id in cart_ids
+                          if cart_id is not None))
+    carts = get_cart_model()._default_manager.db_manager(using)
+    for start in range(0, len(cart_ids), DELETE_BATCH_SIZE):
+        carts.filter(pk__in=cart_ids[start:start + DELETE_BATCH_SIZE]).update(
+            version=F('version') + 1)
+    bump_versions(cart_ids, using)
+
+
+def recompute_totals(cart_ids, using=None):
+    """
+    Set the stored totals of the carts ``cart_ids`` to the ones of their
+    items, with one UPDATE per DELETE_BATCH_SIZE carts that computes them in
+    subqueries, so that changes made meanwhile are never overwritten with
+    totals read before them.
+    """
+    cart_model = get_cart_model()
+    items = Item.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+
+    def total(name, aggregate):
+        field = cart_model._meta.get_field(name)
+        return Coalesce(Subquery(items.annotate(total=aggregate)
+                                 .values('total'), output_field=field),
+                        Value(field.get_default()), output_field=field)
+
+    carts = cart_model._default_manager.db_manager(using)
+    cart_ids = sorted(cart_ids)
+    for start in range(0, len(cart_ids), DELETE_BATCH_SIZE):
+        carts.filter(pk__in=cart_ids[start:start + DELETE_BATCH_SIZE]).update(
+            stored_total_price=total('stored_total_price', Sum(line_total())),
+            stored_total_quantity=total('stored_total_quantity',
+                                        Sum('quantity')),
+            item_count=total('item_count', Count('id')))
+
 
 class BaseCart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, verbose_name='carts')
@@ -27,8 +280,23 @@ class BaseCart(models.Model):
                                          default=timezone.now)
     checked_out = models.BooleanField(default=False,
                                       verbose_name=_('checked out'))
-    items = models.ManyToManyField('changuito.Item', related_name='cart',
-                                   verbose_name=_('items'))
+    if not items_fk:
+        items = models.ManyToManyField('changuito.Item', related_name='cart',
+                                       verbose_name=_('items'))
+
+    # Totals kept up to date by CartProxy when CART_DENORMALIZED_TOTALS is set
+    stored_total_price = models.DecimalField(max_digits=24, decimal_places=5,
+                                             default=Decimal('0'),
+                                             verbose_name=_('total price'))
+    stored_total_quantity = models.DecimalField(max_digits=18,
+                                                decimal_places=3,
+                                                default=Decimal('0'),
+                                                verbose_name=_('total quantity'))
+    item_count = models.PositiveIntegerField(default=0,
+                                             verbose_name=_('item count'))
+    # Bumped by every change of the cart, see CartProxy.version
+    version = models.PositiveIntegerField(default=0,
+                                          verbose_name=_('version'))
 
     class Meta:
         abstract = True
@@ -36,18 +304,96 @@ class BaseCart(models.Model):
         verbose_name_plural = _('carts')
         ordering = ('-creation_date',)
         app_label = 'changuito'
+        indexes = [
+            # Last open cart of a user, see CartProxy.get_user_last_cart
+            PartialIndex(fields=['user', 'creation_date'],
+                         condition=Q(checked_out=False),
+                         fallback_fields=['user', 'checked_out',
+                                          'creation_date'],
+                         name='%(app_label)s_%(class)s_user_open'),
+        ]
 
     def __unicode__(self):
         return '{} - {} (id={})'.format(self.creation_date, self.user, self.id)
 
+    def delete(self, *args, **kwargs):
+        # Items are not deleted by the cascade of the many to many
+        with transaction.atomic(using=router.db_for_write(type(self),
+                                                          instance=self),
+                                savepoint=False):
+            delete_items(type(self)._default_manager.filter(pk=self.pk))
+            return super(BaseCart, self).delete(*args, **kwargs)
+
+    def clear(self, send_signals=True):
+        """Delete all the items of the cart in bulk and reset its totals."""
+        with transaction.atomic(using=router.db_for_write(type(self),
+                                                          instance=self),
+                                savepoint=False):
+            delete_items(type(self)._default_manager.filter(pk=self.pk),
+                         send_signals)
+            self.reset_totals()
+
     def is_empty(self):
-        return self.items.count() == 0
+        if uses_denormalized_totals():
+            return self.item_count == 0
+        return not self.items.exists()
+
+    def summary(self):
+        """
+        Total price, total quantity and number of items of the cart, read
+        from the stored totals or computed by the database in one query.
+        """
+        if uses_denormalized_totals():
+            return {
+                'total_price': self.stored_total_price,
+                'total_quantity': self.stored_total_quantity,
+                'item_count': self.item_count,
+            }
+        return self.compute_summary()
+
+    def compute_summary(self):
+        """Like ``summary`` but always computed by the database."""
+        totals = self.items.aggregate(total_price=Sum(line_total()),
+                                      total_quantity=Sum('quantity'),
+                                      item_count=Count('id'))
+        return {
+            'total_price': totals['total_price'] or Decimal('0'),
+            'total_quantity': totals['total_quantity'] or Decimal('0'),
+            'item_count': totals['item_count'],
+        }
 
     def total_price(self):
-        return sum(i.total_price for i in self.items.all())
+        return self.summary()['total_price']
 
     def total_quantity(self):
-        return sum(i.quantity for i in self.items.all())
+        return self.summary()['total_quantity']
+
+    def adjust_totals(self, price=0, quantity=0, count=0):
+        """
+        Shift the stored totals with a single F-expression UPDATE. Does
+        nothing unless CART_DENORMALIZED_TOTALS is enabled.
+        """
+        if not uses_denormalized_totals() or not (price or quantity or count):
+            return
+        price = self._meta.get_field('stored_total_price').to_python(price)
+        quantity = self._meta.get_field('stored_total_quantity').to_python(
+            quantity)
+        type(self)._default_manager.filter(pk=self.pk).update(
+            **totals_delta(price, quantity, count))
+        self.stored_total_price += price
+        self.stored_total_quantity += quantity
+        self.item_count += count
+
+    def reset_totals(self):
+        if not uses_denormalized_totals():
+            return
+        self.stored_total_price = Decimal('0')
+        self.stored_total_quantity = Decimal('0')
+        self.item_count = 0
+        type(self)._default_manager.filter(pk=self.pk).update(
+            stored_total_price=self.stored_total_price,
+            stored_total_quantity=self.stored_total_quantity,
+            item_count=self.item_count)
 
 
 if not cart_model:
@@ -68,11 +414,28 @@ class Item(models.Model):
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey('content_type', 'object_id')
 
+    if items_fk:
+        cart = models.ForeignKey(cart_model or 'changuito.Cart',
+                                 on_delete=models.CASCADE, null=True,
+                                 blank=True, related_name='items',
+                                 verbose_name=_('cart'))
+
     class Meta:
         verbose_name = _('item')
         verbose_name_plural = _('items')
         ordering = ('cart',)
         app_label = 'changuito'
+        indexes = [
+            models.Index(fields=['content_type', 'object_id'],
+                         name='changuito_item_product'),
+        ]
+        if items_fk:
+            unique_together = (('cart', 'content_type', 'object_id'),)
+
+    # Id of the line of a cart kept outside the database, see
+    # SerializedCartProxy and ArchivedCart. Such items have no primary key
+    # and can't be written.
+    line_id = None
 
     def __unicode__(self):
         return '{0} units of {1} {2}'\
@@ -82,16 +445,139 @@ class Item(models.Model):
 
     @property
     def total_price(self):
-        return float(self.quantity) * float(self.unit_price)
+        return self.quantity * self.unit_price
+
+    def save(self, *args, **kwargs):
+        if self.line_id is not None:
+            raise ItemIsDetached
+        return super(Item, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        if self.line_id is not None:
+            raise ItemIsDetached
+        return super(Item, self).delete(*args, **kwargs)
+
+    def _adjust_cart_totals(self, price, quantity):
+        if uses_denormalized_totals() and (price or quantity):
+            get_cart_model()._default_manager.filter(items=self).update(
+                **totals_delta(price, quantity))
+
+    def _invalidate_carts(self):
+        # Versions and cached snapshots of the carts, see CartProxy
+        if items_fk:
+            touch_carts([self.cart_id])
+        else:
+            touch_carts(get_cart_model()._default_manager.filter(
+                items=self).values_list('pk', flat=True))
 
     def update_quantity(self, quantity):
-        self.quantity = quantity
+        old, self.quantity = to_quantity(self.quantity), to_quantity(quantity)
         self.save()
+        if uses_denormalized_totals():
+            delta = self.quantity - old
+            self._adjust_cart_totals(delta * to_price(self.unit_price), delta)
+        self._invalidate_carts()
 
     def update_price(self, price):
-        self.unit_price = price
+        old, self.unit_price = to_price(self.unit_price), to_price(price)
         self.save()
+        if uses_denormalized_totals():
+            self._adjust_cart_totals(
+                (self.unit_price - old) * to_quantity(self.quantity), 0)
+        self._invalidate_carts()
 
     def update_contenttype(self, content_object):
         self.content_object = content_object
         self.save()
+
+
+def to_quantity(value):
+    """``value``, e.g. a float or a string, as the Decimal of a quantity."""
+    return Item._meta.get_field('quantity').to_python(value)
+
+
+def to_price(value):
+    """``value``, e.g. a float or a string, as the Decimal of a unit price."""
+    return Item._meta.get_field('unit_price').to_python(value)
+
+
+class ArchivedCart(models.Model):
+    """
+    Append-only copy of a checked-out cart, moved out of the cart and item
+    tables by ``archive_carts``. Its items are kept in ``lines`` as a JSON
+    list of ``[id, content_type_id, object_id, quantity, unit_price]``, and
+    it answers the read-only methods of ``BaseCart``.
+    """
+    cart_id = models.PositiveIntegerField(unique=True,
+                                          verbose_name=_('cart id'))
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True,
+                             blank=True, verbose_name=_('user'))
+    creation_date = models.DateTimeField(verbose_name=_('creation date'))
+    archive_date = models.DateTimeField(default=timezone.now,
+                                        verbose_name=_('archive date'))
+    stored_total_price = models.DecimalField(max_digits=24, decimal_places=5,
+                                             verbose_name=_('total price'))
+    stored_total_quantity = models.DecimalField(max_digits=18,
+                                                decimal_places=3,
+                                                verbose_name=_('total quantity'))
+    item_count = models.PositiveIntegerField(verbose_name=_('item count'))
+    lines = models.TextField(verbose_name=_('lines'))
+
+    checked_out = True
+
+    class Meta:
+        verbose_name = _('archived cart')
+        verbose_name_plural = _('archived carts')
+        ordering = ('-creation_date',)
+        app_label = 'changuito'
+        indexes = [
+            models.Index(fields=['user', 'creation_date'],
+                         name='changuito_archivedcart_user'),
+        ]
+
+    def __unicode__(self):
+        return '{} - {} (cart id={})'.format(self.creation_date, self.user,
+                                             self.cart_id)
+
+    @classmethod
+    def from_lines(cls, cart_id, user_id, creation_date, lines):
+        quantities = [Decimal(line[3]) for line in lines]
+        prices = [Decimal(line[4]) for line in lines]
+        return cls(cart_id=cart_id, user_id=user_id,
+                   creation_date=creation_date,
+                   stored_total_price=sum(
+                       (quantity * price for quantity, price
+                        in zip(quantities, prices)), Decimal('0')),
+                   stored_total_quantity=sum(quantities, Decimal('0')),
+                   item_count=len(lines),
+                   lines=json.dumps(lines, separators=(',', ':')))
+
+    def get_items(self):
+        """
+        The lines of the cart as read-only ``Item`` instances, with the id
+        of the archived item as their ``line_id``.
+        """
+        items = []
+        for line_id, ct_id, object_id, quantity, price in json.loads(
+                self.lines):
+            item = Item(content_type_id=ct_id, object_id=object_id,
+                        quantity=Decimal(quantity), unit_price=Decimal(price))
+            item.line_id = line_id
+            items.append(item)
+        return items
+
+    def is_empty(self):
+        return self.item_count == 0
+
+    def summary(self):
+        return {
+            'total_price': self.stored_total_price,
+            'total_quantity': self.stored_total_quantity,
+            'item_count': self.item_count,
+        }
+
+    def total_price(self):
+        return self.stored_total_price
+
+    def total_quantity(self):
+        return self.stored_total_quantity
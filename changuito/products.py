@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from collections import namedtuple
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+
+# Identifies a product without loading it, e.g. to add it to a cart when only
+# its id is known
+ProductKey = namedtuple('ProductKey', ['content_type_id', 'object_id'])
+
+# Process-wide maps between concrete product models and content type ids
+_content_type_ids = {}
+_models = {}
+
+
+def _warm():
+    # Also fills the cache of ContentType.objects, used by GenericForeignKey
+    models = [model for model in apps.get_models() if not model._meta.proxy]
+    for model, ct in ContentType.objects.get_for_models(*models).items():
+        _content_type_ids[model] = ct.id
+        _models[ct.id] = model
+
+
+def clear_content_types(**kwargs):
+    """Forget the maps, e.g. when content types are created or deleted."""
+    _content_type_ids.clear()
+    _models.clear()
+
+
+def get_content_type_id(model):
+    """
+    Content type id of ``model``, a model class or instance. All content types
+    are loaded with one query the first time, then only unknown models query
+    the database.
+    """
+    model = model._meta.concrete_model
+    if not _content_type_ids:
+        _warm()
+    if model not in _content_type_ids:
+        ct = ContentType.objects.get_for_model(model)
+        _content_type_ids[model] = ct.id
+        _models[ct.id] = model
+    return _content_type_ids[model]
+
+
+def get_product_model(content_type_id):
+    """Model class of a content type id, ``None`` for stale content types."""
+    if not _models:
+        _warm()
+    if content_type_id not in _models:
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            return None
+        _content_type_ids[model] = content_type_id
+        _models[content_type_id] = model
+    return _models[content_type_id]
+
+
+def product_key(product):
+    """``ProductKey`` of a model instance, or the key itself."""
+    if isinstance(product, ProductKey):
+        return product
+    return ProductKey(get_content_type_id(product), product.pk)
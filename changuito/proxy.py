@@ -2,14 +2,29 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
+import json
+import operator
+from collections import OrderedDict
 from datetime import datetime as timezone
+from decimal import Decimal
 
 from django.apps import apps
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import F, Q
+from django.utils.module_loading import import_string
 
-from .exceptions import CartDoesNotExist, ItemDoesNotExist
-from .models import Item
+from .cache import (bump_versions, get_snapshot, get_snapshot_cache,
+                    get_version, set_snapshot)
+from .exceptions import (CartAlreadyCheckedOut, CartDoesNotExist,
+                         ItemDoesNotExist)
+from .instrumentation import instrumented, measure, summarize
+from .models import (ArchivedCart, Item, archive_carts, delete_carts,
+                     delete_item_ids, items_fk, to_price, to_quantity,
+                     uses_denormalized_totals)
+from .products import ProductKey, get_product_model, product_key
+from .routers import is_pinned, pin_cart, read_database, write_database
 
 try:
     cart_model = settings.CART_MODEL
@@ -20,102 +35,835 @@ except AttributeError:
 
 CART_ID = 'CART-ID'
 
+# Item fields of the lines of CartProxy.snapshot
+SNAPSHOT_FIELDS = ('id', 'content_type_id', 'object_id', 'quantity',
+                   'unit_price')
+
+# Summary of a request without a cart yet
+EMPTY_SUMMARY = {
+    'total_price': Decimal('0'),
+    'total_quantity': Decimal('0'),
+    'item_count': 0,
+}
+
+
+def _keep_user(user_quantity, quantity):
+    return user_quantity
+
+
+def _replace(current_quantity, quantity):
+    return quantity
+
+
+# Quantity of a product in both carts of a merge, from the quantities in the
+# cart of the user and in the merged one
+MERGE_POLICIES = {
+    'sum': operator.add,
+    'max': max,
+    'keep-user': _keep_user,
+}
+
+
+def get_merge_policy():
+    """CART_MERGE_POLICY, ``None`` when anonymous carts are not merged."""
+    return getattr(settings, 'CART_MERGE_POLICY', 'sum')
+
+
+def cart_proxy_class(request):
+    """
+    Proxy class for the cart of ``request``: CART_ANONYMOUS_PROXY (a dotted
+    path) for anonymous users if set, ``CartProxy`` otherwise.
+    """
+    path = getattr(settings, 'CART_ANONYMOUS_PROXY', None)
+    if not path or not request.user.is_anonymous:
+        return CartProxy
+    # Anonymous carts already in the database, e.g. spilled from a cookie,
+    # keep being used
+    if request.session.get(CART_ID):
+        return CartProxy
+    return import_string(path)
+
+
+def _products_lookup(keys):
+    """Filter matching the (content_type_id, object_id) product keys."""
+    lookup = Q()
+    by_ctype = {}
+    for ct_id, object_id in keys:
+        by_ctype.setdefault(ct_id, []).append(object_id)
+    for ct_id, object_ids in by_ctype.items():
+        lookup |= Q(content_type_id=ct_id, object_id__in=object_ids)
+    return lookup
+
+
+def _hints_key(hints):
+    if not hints:
+        return ()
+    return tuple(sorted((model._meta.label, tuple(fields))
+                        for model, fields in hints.items()))
+
 
 class CartProxy(object):
 
-    def __init__(self, request):
-        self.cart = self.__class__.get_cart(request)
+    def __init__(self, request, lazy=False):
+        self.request = request
+        self._cart = None
+        self._items = None
+        self._memo = {}
+        self.metrics = []
+        if not lazy:
+            self._get_cart()
+
+    @property
+    def cart(self):
+        # Lazy proxies look up (and create) their cart on first use only
+        if self._cart is None:
+            self._get_cart()
+            self.remember_cart()
+        return self._cart
+
+    def _get_cart(self):
+        with measure('get_cart', self):
+            self._cart = self.__class__.get_cart(self.request)
+        # Fresh from the database until the cart changes, see version
+        self._memo['cart_version'] = getattr(self._cart, 'version', None)
+
+    def _existing_cart(self):
+        # Reads don't create the cart, it is ``None`` until a change does
+        if self._cart is None and 'no_cart' not in self._memo:
+            with measure('get_cart', self):
+                cart = self.__class__.find_cart(self.request)
+            if cart is None:
+                self._memo['no_cart'] = True
+            else:
+                self._cart = cart
+                self._memo['cart_version'] = cart.version
+                self.remember_cart()
+        return self._cart
+
+    @cart.setter
+    def cart(self, cart):
+        self._cart = cart
+        self._changed()
+
+    @property
+    def is_resolved(self):
+        return self._cart is not None
+
+    def metrics_summary(self):
+        """
+        Number of calls, queries, database and wall time per operation of
+        this proxy, when CART_INSTRUMENTATION is enabled.
+        """
+        return summarize(self.metrics)
+
+    def remember_cart(self):
+        session = self.request.session
+        # Avoid flagging the session as modified when nothing changed
+        if session.get(CART_ID) != self._cart.id:
+            session[CART_ID] = self._cart.id
 
     def __iter__(self):
-        for item in self.cart.items.all():
+        for item in self.items_with_products():
             yield item
 
+    def _changed(self):
+        # Called by every method that modifies the cart
+        self._items = None
+        self._memo = {}
+        if self._cart is not None:
+            # Later reads must not miss the change on a lagging replica
+            pin_cart(self._cart, self.request)
+            bump_versions([self._cart.pk],
+                          router.db_for_write(Item, instance=self._cart))
+
+    def _cached_snapshot(self):
+        """
+        Items and summary of the cart kept in CART_SNAPSHOT_CACHE under its
+        current version, built and stored on a miss. ``None`` when snapshots
+        are not cached across requests.
+        """
+        cache = get_snapshot_cache()
+        if cache is None:
+            return None
+        if 'snapshot' in self._memo:
+            return self._memo['snapshot']
+        # The session knows the id of the cart, so a lazy proxy can be
+        # served without querying the database
+        cart_id = (self._cart.pk if self._cart is not None
+                   else self.request.session.get(CART_ID))
+        snapshot = None
+        if cart_id:
+            version, snapshot = get_snapshot(cache, cart_id)
+            if snapshot is not None and not self._is_own(snapshot):
+                snapshot = None
+        if snapshot is None:
+            cart = self._existing_cart()
+            snapshot = self._build_snapshot(cart)
+            if cart is not None:
+                if cart.pk != cart_id:
+                    cart_id = cart.pk
+                    version = get_version(cache, cart_id)
+                set_snapshot(cache, cart_id, version, snapshot)
+        self._memo['snapshot'] = snapshot
+        return snapshot
+
+    def _is_own(self, snapshot):
+        # Whether a snapshot found through the session is one of the cart
+        # get_cart would look up, the session may keep the id of a cart
+        # checked out since or of another user
+        if snapshot['user_id'] != self.request.user.pk:
+            return False
+        return self._cart is not None or not snapshot.get('checked_out', True)
+
+    def _build_snapshot(self, cart):
+        items = list(cart.items.all()) if cart is not None else []
+        fields = [field.attname for field in Item._meta.concrete_fields]
+        if cart is not None and uses_denormalized_totals():
+            summary = cart.summary()
+        else:
+            summary = {
+                'total_price': sum((item.total_price for item in items),
+                                   Decimal('0')),
+                'total_quantity': sum((item.quantity for item in items),
+                                      Decimal('0')),
+                'item_count': len(items),
+            }
+        return {
+            'user_id': self.request.user.pk if cart is None else cart.user_id,
+            'checked_out': cart is not None and cart.checked_out,
+            'fields': fields,
+            'rows': [[getattr(item, field) for field in fields]
+                     for item in items],
+            'summary': summary,
+        }
+
+    def _cart_items(self):
+        snapshot = self._cached_snapshot()
+        if snapshot is None:
+            cart = self._existing_cart()
+            return list(cart.items.all()) if cart is not None else []
+        db = router.db_for_read(Item)
+        return [Item.from_db(db, snapshot['fields'], row)
+                for row in snapshot['rows']]
+
+    def _summary(self):
+        if 'summary' not in self._memo:
+            snapshot = self._cached_snapshot()
+            if snapshot is not None:
+                summary = snapshot['summary']
+            else:
+                cart = self._existing_cart()
+                summary = cart.summary() if cart is not None else EMPTY_SUMMARY
+            self._memo['summary'] = summary
+        return dict(self._memo['summary'])
+
+    @instrumented('iteration')
+    def items_with_products(self, select_related=None, only=None):
+        """
+        Items of the cart with their ``content_object`` already loaded, using
+        one query per distinct product content type.
+
+        ``select_related`` and ``only`` map product models to the field names
+        passed to the homonymous queryset methods when loading them. The
+        result is cached on the proxy until the cart is modified.
+        """
+        hints = (_hints_key(select_related), _hints_key(only))
+        if self._items is not None and self._items[0] == hints:
+            return self._items[1]
+        items = self._cart_items()
+        self._load_products(items, select_related, only)
+        self._items = (hints, items)
+        return items
+
+    @staticmethod
+    def _load_products(items, select_related=None, only=None):
+        object_ids = {}
+        for item in items:
+            object_ids.setdefault(item.content_type_id, set()).add(item.object_id)
+        products = {}
+        for ct_id, ids in object_ids.items():
+            model = get_product_model(ct_id)
+            if model is None:
+                continue
+            queryset = model._default_manager.filter(pk__in=ids)
+            if select_related and model in select_related:
+                queryset = queryset.select_related(*select_related[model])
+            if only and model in only:
+                queryset = queryset.only(*only[model])
+            for product in queryset:
+                products[(ct_id, product.pk)] = product
+        for item in items:
+            product = products.get((item.content_type_id, item.object_id))
+            if product is not None:
+                item.content_object = product
+
     @classmethod
     def get_cart(cls, request):
+        cart = cls.find_cart(request)
+        if cart is None:
+            cart = cls.new_cart(
+                user=None if request.user.is_anonymous else request.user)
+        return cart
+
+    @classmethod
+    def find_cart(cls, request):
+        """
+        The open cart of ``request``, like ``get_cart`` but ``None`` instead
+        of a new cart when it has none.
+        """
+        cart_id = request.session.get(CART_ID)
+        # A cart changed recently is read from the write database
+        using = write_database() if is_pinned(cart_id, request) else None
         try:
-            if request.user.is_anonymous:
-                if CART_ID in request.session and request.session[CART_ID]:
-                    cart_id = request.session.get(CART_ID)
-                    cart = Cart.objects.get(id=cart_id, checked_out=False)
-                else:
-                    cart = cls.new_cart()
-            else:
-                cart = cls.get_user_last_cart(request.user)
+            if not request.user.is_anonymous:
+                return cls.get_user_last_cart(request.user, using)
+            if cart_id:
+                return cls.get_open_cart(cart_id, using)
         except CartDoesNotExist:
-            cart = cls.new_cart(user=request.user)
-        return cart
+            if cart_id:
+                # Checked out, purged or archived since
+                del request.session[CART_ID]
+        return None
+
+    @staticmethod
+    def get_open_cart(cart_id, using=None):
+        """
+        The cart ``cart_id`` if it is not checked out. It is looked up again
+        in the write database when missing from a replica, which may lag
+        behind.
+        """
+        try:
+            return Cart.objects.db_manager(using).get(id=cart_id,
+                                                      checked_out=False)
+        except Cart.DoesNotExist:
+            if using is None and read_database() != write_database():
+                return CartProxy.get_open_cart(cart_id, write_database())
+            raise CartDoesNotExist
 
     @classmethod
     def new_cart(cls, user=None):
         return Cart.objects.create(creation_date=timezone.now(), user=user)
 
+    @instrumented('add_item')
     def add_item(self, content_object, unit_price, quantity=1):
-        try:
-            item = self.cart.items.get(content_type=ContentType.objects
-                                       .get_for_model(content_object),
-                                       object_id=content_object.id)
-            item.quantity += quantity
-            item.save()
-        except Item.DoesNotExist:
-            item = Item.objects.create(
-                quantity=quantity,
-                unit_price=unit_price,
-                content_object=content_object
-            )
-            self.cart.items.add(item)
+        """
+        Add ``quantity`` units of ``content_object`` to the cart. It can be
+        a model instance or a ``ProductKey``.
+
+        Safe under concurrent calls: an existing line is increased with a
+        single ``UPDATE ... SET quantity = quantity + n`` and a missing one
+        is created under the (cart, product) unique key of CART_ITEMS_FK, or
+        while holding the lock on the cart row otherwise.
+
+        Like every method that changes the cart, it locks the cart row for
+        the duration of its transaction and raises ``CartAlreadyCheckedOut``
+        once the cart is checked out.
+        """
+        key = product_key(content_object)
+        unit_price, quantity = to_price(unit_price), to_quantity(quantity)
+        lines = self.cart.items.filter(content_type_id=key.content_type_id,
+                                       object_id=key.object_id)
+        db = router.db_for_write(Item, instance=self.cart)
+        with transaction.atomic(using=db):
+            self._lock_cart(db)
+            created = False
+            if not lines.update(quantity=F('quantity') + quantity):
+                try:
+                    with transaction.atomic(using=db):
+                        item = self.cart.items.create(
+                            quantity=quantity,
+                            unit_price=unit_price,
+                            content_type_id=key.content_type_id,
+                            object_id=key.object_id
+                        )
+                    created = True
+                except IntegrityError:
+                    # Created by a concurrent call since the update
+                    lines.update(quantity=F('quantity') + quantity)
+            if not created:
+                item = lines.get()
+            if uses_denormalized_totals():
+                self.cart.adjust_totals(quantity * item.unit_price, quantity,
+                                        int(created))
+        self._changed()
         return item
 
+    def _lock_cart(self, using):
+        # Locks the cart row until the end of the transaction by bumping its
+        # version, and refuses carts checked out since they were read. A
+        # write takes the lock on every backend, where a read lock first
+        # would make SQLite deadlock.
+        if not type(self.cart)._default_manager.using(using).filter(
+                pk=self.cart.pk, checked_out=False).update(
+                version=F('version') + 1):
+            self.cart.checked_out = True
+            raise CartAlreadyCheckedOut
+
+    @instrumented('add_items')
+    def add_items(self, lines):
+        """
+        Add several ``(content_object, unit_price, quantity)`` lines at once.
+
+        Quantities of products already in the cart are increased, like
+        ``add_item`` does, but all lines are read with a single query and
+        written in bulk inside one transaction.
+        """
+        return self._upsert_items(lines, increment=True)
+
+    @instrumented('set_quantities')
+    def set_quantities(self, lines):
+        """
+        Like ``add_items`` but sets the quantity of existing lines instead of
+        increasing it. Products not yet in the cart are added.
+        """
+        return self._upsert_items(lines, increment=False)
+
+    def _upsert_items(self, lines, increment):
+        wanted = OrderedDict()
+        for content_object, unit_price, quantity in lines:
+            key = product_key(content_object)
+            unit_price, quantity = to_price(unit_price), to_quantity(quantity)
+            if increment and key in wanted:
+                quantity += wanted[key][1]
+            wanted[key] = (unit_price, quantity)
+        return self._upsert_lines(
+            wanted, MERGE_POLICIES['sum'] if increment else _replace)
+
+    def _upsert_lines(self, wanted, merge):
+        # ``wanted`` maps (content_type_id, object_id) to (unit_price, quantity)
+        # and ``merge`` gives the new quantity of the lines already in the cart
+        if not wanted:
+            return []
+
+        db = router.db_for_write(Item, instance=self.cart)
+        with transaction.atomic(using=db):
+            self._lock_cart(db)
+            existing = dict(((item.content_type_id, item.object_id), item)
+                            for item in self.cart.items.using(db).filter(
+                                _products_lookup(wanted)))
+            items, changed, new = [], [], []
+            price_delta = quantity_delta = 0
+            for key, (unit_price, quantity) in wanted.items():
+                item = existing.get(key)
+                if item is None:
+                    item = Item(content_type_id=key[0], object_id=key[1],
+                                unit_price=unit_price, quantity=quantity)
+                    new.append(item)
+                    delta = quantity
+                else:
+                    quantity = merge(item.quantity, quantity)
+                    delta = quantity - item.quantity
+                    if delta:
+                        item.quantity = quantity
+                        changed.append(item)
+                price_delta += delta * item.unit_price
+                quantity_delta += delta
+                items.append(item)
+            if changed:
+                Item.objects.using(db).bulk_update(changed, ['quantity'])
+            if new:
+                self._create_items(new, db)
+            self.cart.adjust_totals(price_delta, quantity_delta, len(new))
+        self._changed()
+        return items
+
+    def _create_items(self, items, db):
+        features = connections[db].features
+        can_return_pks = getattr(
+            features, 'can_return_rows_from_bulk_insert',
+            getattr(features, 'can_return_ids_from_bulk_insert', False))
+        if items_fk:
+            for item in items:
+                item.cart = self.cart
+            Item.objects.using(db).bulk_create(items)
+            if not can_return_pks:
+                # Read the primary keys back through the unique product key
+                pks = dict(((ct_id, object_id), pk) for pk, ct_id, object_id
+                           in self.cart.items.using(db).filter(_products_lookup(
+                               (item.content_type_id, item.object_id)
+                               for item in items)).values_list(
+                               'pk', 'content_type_id', 'object_id'))
+                for item in items:
+                    item.pk = pks[(item.content_type_id, item.object_id)]
+            return
+        if can_return_pks:
+            Item.objects.using(db).bulk_create(items)
+        else:
+            # Primary keys are needed for the through table
+            for item in items:
+                item.save(using=db)
+        field = self.cart._meta.get_field('items')
+        through = field.remote_field.through
+        source = '{}_id'.format(field.m2m_field_name())
+        target = '{}_id'.format(field.m2m_reverse_field_name())
+        through.objects.using(db).bulk_create(
+            [through(**{source: self.cart.pk, target: item.pk})
+             for item in items])
+
+    @instrumented('remove_item')
     def remove_item(self, item_id):
-        try:
-            self.cart.items.get(id=item_id).delete()
-        except Item.DoesNotExist:
-            raise ItemDoesNotExist
+        db = router.db_for_write(Item, instance=self.cart)
+        with transaction.atomic(using=db):
+            self._lock_cart(db)
+            try:
+                item = self.cart.items.using(db).get(id=item_id)
+            except Item.DoesNotExist:
+                raise ItemDoesNotExist
+            item.delete(using=db)
+            self.cart.adjust_totals(-item.total_price, -item.quantity, -1)
+        self._changed()
 
+    @instrumented('get_item')
     def get_item(self, item_id):
-        try:
-            item = self.cart.items.get(id=item_id)
-        except Item.DoesNotExist:
-            raise ItemDoesNotExist
-        return item
+        items = self._memo.setdefault('items', {})
+        if item_id not in items:
+            if self._cached_snapshot() is not None:
+                found = [item for item in self._cart_items()
+                         if item.pk == int(item_id)]
+                if not found:
+                    raise ItemDoesNotExist
+                items[item_id] = found[0]
+            else:
+                cart = self._existing_cart()
+                try:
+                    if cart is None:
+                        raise Item.DoesNotExist
+                    items[item_id] = cart.items.get(id=item_id)
+                except Item.DoesNotExist:
+                    raise ItemDoesNotExist
+        return items[item_id]
 
-    def clear_items(self):
-        for item in self.cart.items.all():
-            item.delete()
+    @instrumented('clear_items')
+    def clear_items(self, send_signals=True):
+        """
+        Delete all the items with bulk DELETEs. ``send_signals=False`` skips
+        the ``pre_delete`` and ``post_delete`` signals of each item.
+        """
+        db = router.db_for_write(type(self.cart), instance=self.cart)
+        with transaction.atomic(using=db):
+            self._lock_cart(db)
+            self.cart.clear(send_signals)
+        self._changed()
 
+    @instrumented('is_empty')
     def is_empty(self):
-        return self.cart.is_empty()
+        if 'summary' in self._memo or get_snapshot_cache() is not None:
+            return self._summary()['item_count'] == 0
+        if 'is_empty' not in self._memo:
+            cart = self._existing_cart()
+            self._memo['is_empty'] = cart is None or cart.is_empty()
+        return self._memo['is_empty']
+
+    @instrumented('totals')
+    def summary(self):
+        """
+        Total price, total quantity and number of items of the cart. Like
+        the other reads of the proxy it is memoized until the cart changes,
+        and served from CART_SNAPSHOT_CACHE when set.
+        """
+        return self._summary()
+
+    def total_price(self):
+        return self.summary()['total_price']
+
+    def total_quantity(self):
+        return self.summary()['total_quantity']
+
+    def version(self):
+        """
+        Version of the cart, replaced by every change of it. It is read from
+        the counters of CART_SNAPSHOT_CACHE without querying the database
+        when it is set, or else from the ``version`` column of the cart row,
+        without reading its items. It is ``'0-0'`` while there is no cart.
+        """
+        if 'version' not in self._memo:
+            cache = get_snapshot_cache()
+            cart_id = self._cart.pk if self._cart is not None else None
+            if not cart_id and cache is not None:
+                cart_id = self.request.session.get(CART_ID)
+            if not cart_id:
+                cart_id = getattr(self._existing_cart(), 'pk', None)
+            if not cart_id:
+                # No cart yet
+                cart_id = version = 0
+            elif cache is not None:
+                version = get_version(cache, cart_id)
+            else:
+                version = self._memo.get('cart_version')
+                if version is None:
+                    cart = self._cart
+                    version = type(cart)._default_manager.using(
+                        router.db_for_read(type(cart), instance=cart)).filter(
+                        pk=cart.pk).values_list('version', flat=True).first()
+            self._memo['version'] = '{}-{}'.format(cart_id, version)
+        return self._memo['version']
+
+    def _snapshot_rows(self):
+        cached = self._cached_snapshot()
+        if cached is None:
+            cart = self._existing_cart()
+            if cart is None:
+                return []
+            return list(cart.items.order_by('pk')
+                        .values_list(*SNAPSHOT_FIELDS))
+        positions = [cached['fields'].index(field)
+                     for field in SNAPSHOT_FIELDS]
+        return sorted(tuple(row[position] for position in positions)
+                      for row in cached['rows'])
+
+    @instrumented('snapshot')
+    def snapshot(self):
+        """
+        JSON-ready dict of the cart, with its ``lines`` (the fields of
+        ``SNAPSHOT_FIELDS`` and ``total_price``), ``total_price``,
+        ``total_quantity``, ``item_count`` and a ``version`` suitable as an
+        ETag. Decimals are strings.
+
+        The lines are read with a single query, none when served from
+        CART_SNAPSHOT_CACHE, and products are not loaded. The version is the
+        one of ``version`` or, when it is ``None``, a digest of the rest.
+        """
+        if 'json' in self._memo:
+            return self._memo['json']
+        # Read before the lines, so it is never newer than them
+        version = self.version()
+        lines = []
+        total_price = total_quantity = Decimal('0')
+        for row in self._snapshot_rows():
+            line = dict(zip(SNAPSHOT_FIELDS, row))
+            line['total_price'] = line['quantity'] * line['unit_price']
+            total_price += line['total_price']
+            total_quantity += line['quantity']
+            for field in ('quantity', 'unit_price', 'total_price'):
+                line[field] = str(line[field])
+            lines.append(line)
+        snapshot = {
+            'lines': lines,
+            'total_price': str(total_price),
+            'total_quantity': str(total_quantity),
+            'item_count': len(lines),
+        }
+        snapshot['version'] = version or hashlib.sha1(json.dumps(
+            snapshot, sort_keys=True).encode('utf-8')).hexdigest()
+        self._memo['json'] = snapshot
+        return snapshot
 
+    @instrumented('update_item_quantity')
     def update_item_quantity(self, content_object, quantity):
-        try:
-            item = self.cart.items.get(content_type=ContentType.objects
-                                       .get_for_model(content_object),
-                                       object_id=content_object.id)
-            item.quantity = quantity
-            item.save()
-        except Item.DoesNotExist:
-            raise ItemDoesNotExist
+        key = product_key(content_object)
+        db = router.db_for_write(Item, instance=self.cart)
+        with transaction.atomic(using=db):
+            self._lock_cart(db)
+            try:
+                item = self.cart.items.using(db).get(
+                    content_type_id=key.content_type_id,
+                    object_id=key.object_id)
+            except Item.DoesNotExist:
+                raise ItemDoesNotExist
+            old, item.quantity = item.quantity, to_quantity(quantity)
+            item.save(using=db)
+            if uses_denormalized_totals():
+                delta = item.quantity - old
+                self.cart.adjust_totals(delta * item.unit_price, delta)
+        self._changed()
 
     @staticmethod
-    def delete_user_last_cart(user):
+    def delete_user_last_cart(user, send_signals=True):
+        """Delete the last open cart of ``user``, if any, and its items."""
         try:
-            cart = Cart.objects.get(user=user)
-            cart.delete()
-        except Cart.DoesNotExist:
-            pass
+            cart = CartProxy.get_user_last_cart(user)
+        except CartDoesNotExist:
+            return
+        delete_carts(Cart.objects.filter(pk=cart.pk), send_signals)
+        bump_versions([cart.pk])
 
     @staticmethod
-    def get_user_last_cart(user):
-        cart = Cart.objects.filter(user=user, checked_out=False).order_by('creation_date').last()
+    def merge_carts(source, target, policy=None):
+        """
+        Move the items of the ``source`` cart into ``target`` and delete
+        ``source``, in one transaction and with a constant number of queries.
+
+        Products already in ``target`` keep its unit price, and the quantity
+        given by ``policy``: ``'sum'``, ``'max'`` or ``'keep-user'`` (the
+        quantity in ``target``), CART_MERGE_POLICY by default.
+
+        Both carts are locked first, like ``CartProxy._lock_cart`` does, and
+        ``CartAlreadyCheckedOut`` is raised if either is checked out.
+        """
+        merge = MERGE_POLICIES[policy or get_merge_policy() or 'sum']
+        db = router.db_for_write(Item, instance=target)
+        with transaction.atomic(using=db):
+            if type(target)._default_manager.using(db).filter(
+                    pk__in=[source.pk, target.pk], checked_out=False).update(
+                    version=F('version') + 1) != 2:
+                raise CartAlreadyCheckedOut
+            lines = {source.pk: {}, target.pk: {}}
+            for pk, cart_id, ct_id, object_id, quantity, unit_price in (
+                    Item.objects.using(db).filter(
+                        cart__in=[source.pk, target.pk]).order_by()
+                    .values_list('pk', 'cart', 'content_type_id', 'object_id',
+                                 'quantity', 'unit_price')):
+                lines[cart_id][(ct_id, object_id)] = Item(
+                    pk=pk, quantity=quantity, unit_price=unit_price)
+            changed, dropped = [], []
+            price_delta = quantity_delta = count_delta = 0
+            for key, item in lines[source.pk].items():
+                current = lines[target.pk].get(key)
+                if current is None:
+                    price_delta += item.total_price
+                    quantity_delta += item.quantity
+                    count_delta += 1
+                    continue
+                dropped.append(item.pk)
+                quantity = merge(current.quantity, item.quantity)
+                if quantity != current.quantity:
+                    price_delta += (quantity - current.quantity) * \
+                        current.unit_price
+                    quantity_delta += quantity - current.quantity
+                    current.quantity = quantity
+                    changed.append(current)
+            if changed:
+                Item.objects.using(db).bulk_update(changed, ['quantity'])
+            if dropped:
+                delete_item_ids(dropped, db)
+            if items_fk:
+                Item.objects.using(db).filter(cart=source).update(cart=target)
+            else:
+                field = source._meta.get_field('items')
+                cart_field = '{}_id'.format(field.m2m_field_name())
+                field.remote_field.through.objects.using(db).filter(
+                    **{cart_field: source.pk}).update(**{cart_field: target.pk})
+            type(source)._default_manager.using(db).filter(
+                pk=source.pk).delete()
+            target.adjust_totals(price_delta, quantity_delta, count_delta)
+        bump_versions([source.pk, target.pk])
+        return target
+
+    @staticmethod
+    def get_user_last_cart(user, using=None):
+        cart = Cart.objects.db_manager(using).filter(user=user, checked_out=False).order_by('creation_date').last()
         if cart:
             return cart
+        # Missing from a lagging replica, see get_open_cart
+        if using is None and read_database() != write_database():
+            return CartProxy.get_user_last_cart(user, write_database())
         raise CartDoesNotExist
 
     @staticmethod
     def n_carts(user):
-        return Cart.objects.filter(user=user).count()
+        """Number of carts of ``user``, archived carts included."""
+        archived = ArchivedCart.objects.filter(user=user).count()
+        return Cart.objects.filter(user=user).count() + archived
+
+    @staticmethod
+    def archived_carts(user):
+        """Archived carts of ``user``, newest first."""
+        return ArchivedCart.objects.filter(user=user)
+
+    @staticmethod
+    def get_archived_cart(cart_id):
+        """The ``ArchivedCart`` of the cart that had id ``cart_id``."""
+        try:
+            return ArchivedCart.objects.get(cart_id=cart_id)
+        except ArchivedCart.DoesNotExist:
+            raise CartDoesNotExist
+
+    @classmethod
+    def archived_items(cls, archived_cart, select_related=None, only=None):
+        """
+        Items of an ``ArchivedCart``, unsaved, with their ``content_object``
+        loaded as ``items_with_products`` does.
+        """
+        items = archived_cart.get_items()
+        cls._load_products(items, select_related, only)
+        return items
+
+    @instrumented('checkout')
+    def checkout(self, pricing=None):
+        """
+        Mark the cart as checked out and store its totals, computed by the
+        database, in one transaction that holds the lock on the cart row, so
+        concurrent changes of the cart wait and then fail with
+        ``CartAlreadyCheckedOut``.
+
+        ``pricing`` re-prices the lines first. It is called once with the
+        ``ProductKey`` of every line and returns a mapping of keys to unit
+        prices, keys left out keep their price. Changed prices are written
+        with a single ``bulk_update``.
 
-    def checkout(self):
+        With CART_ARCHIVE_ON_CHECKOUT the cart is then moved to an
+        ``ArchivedCart`` in the same transaction, see ``archive_carts``.
+
+        The proxy keeps the checked-out cart for the rest of the request, but
+        it is forgotten by the session, so later requests get a new cart.
+        """
         cart = self.cart
-        cart.checked_out = True
-        cart.save()
+        db = router.db_for_write(type(cart), instance=cart)
+        with transaction.atomic(using=db):
+            self._lock_cart(db)
+            if pricing is not None:
+                self._reprice(pricing, db)
+            totals = cart.compute_summary()
+            cart.checked_out = True
+            cart.stored_total_price = totals['total_price']
+            cart.stored_total_quantity = totals['total_quantity']
+            cart.item_count = totals['item_count']
+            type(cart)._default_manager.using(db).filter(pk=cart.pk).update(
+                checked_out=True,
+                stored_total_price=cart.stored_total_price,
+                stored_total_quantity=cart.stored_total_quantity,
+                item_count=cart.item_count)
+            if getattr(settings, 'CART_ARCHIVE_ON_CHECKOUT', False):
+                archive_carts(type(cart)._default_manager.filter(pk=cart.pk))
+        self._changed()
+        if self.request.session.get(CART_ID) == cart.pk:
+            del self.request.session[CART_ID]
         return cart
+
+    def _reprice(self, pricing, using):
+        items = list(self.cart.items.using(using).select_for_update()
+                     .order_by('pk'))
+        prices = pricing([ProductKey(item.content_type_id, item.object_id)
+                          for item in items])
+        changed = []
+        for item in items:
+            price = prices.get((item.content_type_id, item.object_id))
+            if price is not None and price != item.unit_price:
+                item.unit_price = price
+                changed.append(item)
+        if changed:
+            Item.objects.using(using).bulk_update(changed, ['unit_price'])
+
+
+def merge_anonymous_cart(sender, request, user, **kwargs):
+    """
+    ``user_logged_in`` receiver merging the cart of the anonymous session into
+    the open cart of the user (see CART_MERGE_POLICY), or giving it to the
+    user when there is none.
+    """
+    policy = get_merge_policy()
+    if request is None or not policy or not hasattr(request, 'session'):
+        return
+    cart_id = request.session.get(CART_ID)
+    if not cart_id:
+        return
+    try:
+        source = Cart.objects.get(pk=cart_id, user=None, checked_out=False)
+    except Cart.DoesNotExist:
+        return
+    try:
+        cart = CartProxy.get_user_last_cart(user)
+    except CartDoesNotExist:
+        source.user = user
+        source.save(update_fields=['user'])
+        cart = source
+    else:
+        try:
+            CartProxy.merge_carts(source, cart, policy)
+        except CartAlreadyCheckedOut:
+            # One of the carts was checked out since it was read
+            return
+    proxy = CartProxy(request, lazy=True)
+    proxy.cart = cart
+    proxy.remember_cart()
+    request.cart = proxy
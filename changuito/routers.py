@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Read/write splitting for the cart models.
+
+    DATABASE_ROUTERS = ['changuito.routers.CartRouter']
+    CART_READ_DATABASE = 'replica'
+
+Reads go to CART_READ_DATABASE and writes to CART_WRITE_DATABASE
+(``'default'`` unless set). ``CartProxy`` pins a cart to the write database
+once it changes it, for the rest of the request and, with CART_PIN_SECONDS,
+for that long in later requests, so that it doesn't read stale rows from a
+lagging replica.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Attribute of carts (and requests) whose reads go to the write database
+PINNED = '_changuito_pinned'
+
+
+def write_database():
+    return getattr(settings, 'CART_WRITE_DATABASE', DEFAULT_DB_ALIAS)
+
+
+def read_database():
+    return getattr(settings, 'CART_READ_DATABASE', None) or write_database()
+
+
+def _pin_seconds():
+    if read_database() == write_database():
+        return 0
+    return getattr(settings, 'CART_PIN_SECONDS', 0)
+
+
+def _pin_key(cart_id):
+    return 'changuito:pin:{}'.format(cart_id)
+
+
+def _pin_cache():
+    return caches[getattr(settings, 'CART_PIN_CACHE', 'default')]
+
+
+def pin_cart(cart, request=None):
+    """
+    Send the reads of ``cart`` to the write database, and those of the carts
+    looked up for ``request`` for the rest of it. With CART_PIN_SECONDS the
+    cart also stays pinned that long for later requests.
+    """
+    setattr(cart, PINNED, True)
+    if request is not None:
+        setattr(request, PINNED, True)
+    seconds = _pin_seconds()
+    if seconds:
+        _pin_cache().set(_pin_key(cart.pk), True, seconds)
+
+
+def is_pinned(cart_id, request=None):
+    """Whether reads of the cart ``cart_id`` go to the write database."""
+    if request is not None and getattr(request, PINNED, False):
+        return True
+    if not cart_id or not _pin_seconds():
+        return False
+    return bool(_pin_cache().get(_pin_key(cart_id)))
+
+
+def is_cart_model(model):
+    if model._meta.app_label == 'changuito':
+        return True
+    return model._meta.label == getattr(settings, 'CART_MODEL', None)
+
+
+class CartRouter(object):
+    """
+    Routes the reads of the cart models to CART_READ_DATABASE, except those
+    made inside a transaction of the write database and those related to a
+    pinned cart or an instance from the write database, and their writes to
+    CART_WRITE_DATABASE. Other models are left
+    to the next routers.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not is_cart_model(model):
+            return None
+        write = write_database()
+        if connections[write].in_atomic_block:
+            return write
+        instance = hints.get('instance')
+        if instance is not None:
+            # Created or loaded from the write database, or changed since
+            if getattr(instance, PINNED, False) or instance._state.db == write:
+                return write
+        return read_database()
+
+    def db_for_write(self, model, **hints):
+        if is_cart_model(model):
+            return write_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The read database is a replica of the write database
+        if is_cart_model(type(obj1)) or is_cart_model(type(obj2)):
+            return True
+        return None
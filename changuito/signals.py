@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from django.dispatch import Signal
+
+# Sent after every instrumented cart operation when CART_INSTRUMENTATION is
+# enabled, with the ``operation`` name, the number of ``queries``, their
+# ``db_time`` and the ``wall_time`` in seconds, and the ``proxy`` (or None).
+cart_operation = Signal()
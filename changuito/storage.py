@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+from decimal import Decimal
+from uuid import uuid4
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .exceptions import CartDoesNotExist, ItemDoesNotExist
+from .instrumentation import instrumented
+from .models import Item, to_price, to_quantity
+from .products import product_key
+from .proxy import (MERGE_POLICIES, CartProxy, _hints_key, _products_lookup,
+                    get_merge_policy)
+
+CART_KEY = 'CART-KEY'
+
+# Positions of the fields of a serialized line
+LINE_ID, LINE_CT, LINE_OBJECT, LINE_QUANTITY, LINE_PRICE = range(5)
+
+
+class DetachedCart(object):
+    """
+    Read-only stand-in for ``BaseCart`` over the lines of a
+    ``SerializedCartProxy``. It has no id since it has no database row.
+    """
+    id = pk = None
+    user = None
+    checked_out = False
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def is_empty(self):
+        return not self._proxy.data['lines']
+
+    def summary(self):
+        lines = self._proxy.data['lines']
+        quantities = [Decimal(line[LINE_QUANTITY]) for line in lines]
+        prices = [Decimal(line[LINE_PRICE]) for line in lines]
+        return {
+            'total_price': sum((quantity * price for quantity, price
+                                in zip(quantities, prices)), Decimal('0')),
+            'total_quantity': sum(quantities, Decimal('0')),
+            'item_count': len(lines),
+        }
+
+    def total_price(self):
+        return self.summary()['total_price']
+
+    def total_quantity(self):
+        return self.summary()['total_quantity']
+
+
+class SerializedCartProxy(CartProxy):
+    """
+    Base proxy for anonymous carts kept outside of the database as a compact
+    list of ``[id, content_type_id, object_id, quantity, unit_price]`` lines.
+
+    Subclasses implement ``load``, ``store`` and ``discard``. The cart is
+    promoted to the relational models on checkout or when the user logs in,
+    and items are read-only ``Item`` instances until then: they have no
+    primary key, ``get_item`` and ``remove_item`` take their ``line_id``.
+    """
+
+    def __init__(self, request, lazy=False):
+        self.request = request
+        self._cart = None
+        self._items = None
+        self._memo = {}
+        self._data = None
+        self.metrics = []
+        if not lazy:
+            self._data = self.load() or self.empty_data()
+
+    @staticmethod
+    def empty_data():
+        return {'seq': 0, 'lines': []}
+
+    def load(self):
+        raise NotImplementedError
+
+    def store(self, data):
+        raise NotImplementedError
+
+    def discard(self):
+        raise NotImplementedError
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.load() or self.empty_data()
+        return self._data
+
+    @property
+    def cart(self):
+        return DetachedCart(self)
+
+    @property
+    def is_resolved(self):
+        return self._data is not None
+
+    def _existing_cart(self):
+        return self.cart
+
+    def remember_cart(self):
+        # Detached carts keep their own reference when they are stored
+        pass
+
+    def _cached_snapshot(self):
+        # The lines are already kept outside of the database
+        return None
+
+    def version(self):
+        # No counter without a database row, snapshot digests the lines
+        return None
+
+    def _snapshot_rows(self):
+        return sorted((line[LINE_ID], line[LINE_CT], line[LINE_OBJECT],
+                       Decimal(line[LINE_QUANTITY]), Decimal(line[LINE_PRICE]))
+                      for line in self.data['lines'])
+
+    def _save(self):
+        self.store(self.data)
+        self._changed()
+
+    def _find_line(self, content_type_id, object_id):
+        for line in self.data['lines']:
+            if line[LINE_CT] == content_type_id and line[LINE_OBJECT] == object_id:
+                return line
+
+    def _line_by_id(self, item_id):
+        for line in self.data['lines']:
+            if line[LINE_ID] == int(item_id):
+                return line
+        raise ItemDoesNotExist
+
+    @staticmethod
+    def _make_item(line):
+        # The line id is not a primary key of the item table
+        item = Item(content_type_id=line[LINE_CT], object_id=line[LINE_OBJECT],
+                    quantity=Decimal(line[LINE_QUANTITY]),
+                    unit_price=Decimal(line[LINE_PRICE]))
+        item.line_id = line[LINE_ID]
+        return item
+
+    def _set_line(self, content_object, unit_price, quantity, increment):
+        key = product_key(content_object)
+        unit_price, quantity = to_price(unit_price), to_quantity(quantity)
+        line = self._find_line(*key)
+        if line is None:
+            self.data['seq'] += 1
+            line = [self.data['seq'], key.content_type_id, key.object_id,
+                    str(quantity), str(unit_price)]
+            self.data['lines'].append(line)
+        elif increment:
+            line[LINE_QUANTITY] = str(Decimal(line[LINE_QUANTITY]) + quantity)
+        else:
+            line[LINE_QUANTITY] = str(quantity)
+        return line
+
+    @instrumented('iteration')
+    def items_with_products(self, select_related=None, only=None):
+        hints = (_hints_key(select_related), _hints_key(only))
+        if self._items is not None and self._items[0] == hints:
+            return self._items[1]
+        items = [self._make_item(line) for line in self.data['lines']]
+        self._load_products(items, select_related, only)
+        self._items = (hints, items)
+        return items
+
+    @instrumented('add_item')
+    def add_item(self, content_object, unit_price, quantity=1):
+        line = self._set_line(content_object, unit_price, quantity, True)
+        self._save()
+        return self._make_item(line)
+
+    @instrumented('add_items')
+    def add_items(self, lines):
+        lines = [self._set_line(obj, unit_price, quantity, True)
+                 for obj, unit_price, quantity in lines]
+        self._save()
+        return [self._make_item(line) for line in lines]
+
+    @instrumented('set_quantities')
+    def set_quantities(self, lines):
+        lines = [self._set_line(obj, unit_price, quantity, False)
+                 for obj, unit_price, quantity in lines]
+        self._save()
+        return [self._make_item(line) for line in lines]
+
+    @instrumented('remove_item')
+    def remove_item(self, item_id):
+        self.data['lines'].remove(self._line_by_id(item_id))
+        self._save()
+
+    @instrumented('get_item')
+    def get_item(self, item_id):
+        return self._make_item(self._line_by_id(item_id))
+
+    @instrumented('clear_items')
+    def clear_items(self, send_signals=True):
+        self.data['lines'] = []
+        self._save()
+
+    @instrumented('update_item_quantity')
+    def update_item_quantity(self, content_object, quantity):
+        line = self._find_line(*product_key(content_object))
+        if line is None:
+            raise ItemDoesNotExist
+        line[LINE_QUANTITY] = str(to_quantity(quantity))
+        self._save()
+
+    def promote(self, user=None, policy=None):
+        """
+        Write the lines into a database cart, the last open cart of ``user``
+        if there is one, and return a ``CartProxy`` for it. The detached
+        cart is discarded. Products already in the cart of the user are
+        merged with ``policy``, see ``CartProxy.merge_carts``.
+        """
+        cart = None
+        if user is not None:
+            try:
+                cart = self.get_user_last_cart(user)
+            except CartDoesNotExist:
+                pass
+        if cart is None:
+            cart = self.new_cart(user=user)
+        proxy = CartProxy(self.request, lazy=True)
+        proxy.cart = cart
+        proxy._upsert_lines(OrderedDict(
+            ((line[LINE_CT], line[LINE_OBJECT]),
+             (Decimal(line[LINE_PRICE]), Decimal(line[LINE_QUANTITY])))
+            for line in self.data['lines']),
+            MERGE_POLICIES[policy or get_merge_policy() or 'sum'])
+        self.discard()
+        self._data = self.empty_data()
+        self._changed()
+        return proxy
+
+    @instrumented('checkout')
+    def checkout(self, pricing=None):
+        return self.promote().checkout(pricing)
+
+
+class CacheCartProxy(SerializedCartProxy):
+    """
+    Keeps anonymous carts in Django's cache framework (CART_CACHE_ALIAS,
+    ``'default'`` unless set) for CART_CACHE_TIMEOUT seconds. Only the cache
+    key is stored in the session, and only once the cart has items.
+    """
+
+    @staticmethod
+    def get_cache():
+        return caches[getattr(settings, 'CART_CACHE_ALIAS', 'default')]
+
+    @staticmethod
+    def cache_key(token):
+        return 'changuito:cart:{}'.format(token)
+
+    def load(self):
+        token = self.request.session.get(CART_KEY)
+        if token:
+            return self.get_cache().get(self.cache_key(token))
+
+    def store(self, data):
+        token = self.request.session.get(CART_KEY)
+        if not token:
+            token = self.request.session[CART_KEY] = uuid4().hex
+        self.get_cache().set(self.cache_key(token), data,
+                             getattr(settings, 'CART_CACHE_TIMEOUT',
+                                     settings.SESSION_COOKIE_AGE))
+
+    def discard(self):
+        token = self.request.session.pop(CART_KEY, None)
+        if token:
+            self.get_cache().delete(self.cache_key(token))
+
+
+def _unless_spilled(name):
+    # Once spilled, the operations of a CookieCartProxy go to the database
+    method = getattr(SerializedCartProxy, name)
+
+    def wrapper(self, *args, **kwargs):
+        if self.spilled_to is not None:
+            return getattr(self.spilled_to, name)(*args, **kwargs)
+        result = method(self, *args, **kwargs)
+        if self.spilled_to is not None and name in CookieCartProxy.RETURN_ITEMS:
+            # The unsaved items of the lines are now rows of the spilled cart
+            unsaved = result if isinstance(result, list) else [result]
+            keys = [(item.content_type_id, item.object_id) for item in unsaved]
+            rows = dict(((item.content_type_id, item.object_id), item)
+                        for item in self.spilled_to.cart.items.filter(
+                            _products_lookup(keys)))
+            saved = [rows[key] for key in keys]
+            return saved if isinstance(result, list) else saved[0]
+        return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class CookieCartProxy(SerializedCartProxy):
+    """
+    Carries anonymous carts in a signed cookie (CART_COOKIE_NAME), so they
+    need no database rows nor session writes. The cookie is written by
+    ``CartMiddleware`` once the response is ready.
+
+    A cart whose signed value exceeds CART_COOKIE_MAX_SIZE bytes is spilled
+    to a database cart, remembered in the session, and ``request.cart``
+    becomes a ``CartProxy`` for it. Carts are also moved to the database
+    when the user logs in, like any ``SerializedCartProxy``.
+    """
+    salt = 'changuito.storage.CookieCartProxy'
+
+    # Operations returning the items of the lines
+    RETURN_ITEMS = ('add_item', 'add_items', 'set_quantities')
+
+    def __init__(self, request, lazy=False):
+        self.spilled_to = None
+        super(CookieCartProxy, self).__init__(request, lazy)
+
+    @staticmethod
+    def cookie_name():
+        return getattr(settings, 'CART_COOKIE_NAME', 'changuito_cart')
+
+    def load(self):
+        # A value set earlier in the request takes precedence
+        value = getattr(self.request, '_cart_cookie',
+                        self.request.COOKIES.get(self.cookie_name()))
+        if value:
+            try:
+                return signing.loads(value, salt=self.salt)
+            except signing.BadSignature:
+                return None
+
+    def store(self, data):
+        if not data['lines']:
+            self.discard()
+            return
+        value = signing.dumps(data, salt=self.salt, compress=True)
+        if len(value) > getattr(settings, 'CART_COOKIE_MAX_SIZE', 2048):
+            self.spill()
+        else:
+            self.request._cart_cookie = value
+
+    def discard(self):
+        self.request._cart_cookie = None
+
+    def spill(self):
+        """Move the cart to the database for good."""
+        proxy = self.promote()
+        proxy.remember_cart()
+        self.spilled_to = self.request.cart = proxy
+
+    @property
+    def cart(self):
+        if self.spilled_to is not None:
+            return self.spilled_to.cart
+        return super(CookieCartProxy, self).cart
+
+    add_item = _unless_spilled('add_item')
+    add_items = _unless_spilled('add_items')
+    set_quantities = _unless_spilled('set_quantities')
+    remove_item = _unless_spilled('remove_item')
+    get_item = _unless_spilled('get_item')
+    clear_items = _unless_spilled('clear_items')
+    update_item_quantity = _unless_spilled('update_item_quantity')
+    items_with_products = _unless_spilled('items_with_products')
+    is_empty = _unless_spilled('is_empty')
+    summary = _unless_spilled('summary')
+    total_price = _unless_spilled('total_price')
+    total_quantity = _unless_spilled('total_quantity')
+    version = _unless_spilled('version')
+    snapshot = _unless_spilled('snapshot')
+    checkout = _unless_spilled('checkout')
+
+
+def update_cart_cookie(request, response):
+    """
+    Write or delete the cookie of a ``CookieCartProxy`` changed during the
+    request. Called by the cart middlewares.
+    """
+    if not hasattr(request, '_cart_cookie'):
+        return
+    name = CookieCartProxy.cookie_name()
+    if request._cart_cookie:
+        response.set_cookie(
+            name, request._cart_cookie,
+            max_age=getattr(settings, 'CART_COOKIE_AGE',
+                            settings.SESSION_COOKIE_AGE),
+            secure=settings.SESSION_COOKIE_SECURE or None,
+            httponly=True, samesite=settings.SESSION_COOKIE_SAMESITE)
+    elif name in request.COOKIES:
+        response.delete_cookie(name, samesite=settings.SESSION_COOKIE_SAMESITE)
+
+
+def promote_anonymous_cart(sender, request, user, **kwargs):
+    """
+    ``user_logged_in`` receiver moving the detached anonymous cart of the
+    session into the database cart of the user.
+    """
+    path = getattr(settings, 'CART_ANONYMOUS_PROXY', None)
+    if request is None or not path:
+        return
+    proxy_class = import_string(path)
+    if not issubclass(proxy_class, SerializedCartProxy):
+        return
+    anonymous_proxy = proxy_class(request, lazy=True)
+    if not anonymous_proxy.is_empty():
+        request.cart = anonymous_proxy.promote(user)
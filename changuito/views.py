@@ -2,4 +2,37 @@
 
 from __future__ import absolute_import, unicode_literals
 
-# Create your views here.
+from django.http import JsonResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_safe
+
+from .proxy import cart_proxy_class
+
+
+def _cart_proxy(request):
+    if getattr(request, 'cart', None) is None:
+        request.cart = cart_proxy_class(request)(request, lazy=True)
+    return request.cart
+
+
+def cart_etag(request):
+    """
+    ETag of the cart of the request, read from the cart row alone. With
+    CART_SNAPSHOT_CACHE it is read from the version counter, without
+    querying the database.
+    """
+    proxy = _cart_proxy(request)
+    return proxy.version() or proxy.snapshot()['version']
+
+
+@require_safe
+@condition(etag_func=cart_etag)
+def cart_snapshot(request):
+    """
+    ``CartProxy.snapshot`` of the cart of the request as JSON, answered with
+    304 Not Modified when it matches ``If-None-Match``.
+    """
+    response = JsonResponse(_cart_proxy(request).snapshot())
+    # Browsers must revalidate, and shared caches must not store it
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
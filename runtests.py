@@ -48,6 +48,15 @@ def is_class(string):
 
 
 if __name__ == '__main__':
+    try:
+        sys.argv.remove('--benchmark')
+    except ValueError:
+        pass
+    else:
+        # `runtests.py --benchmark [benchmark options]`
+        from benchmarks.cart_operations import main
+        sys.exit(main(sys.argv[1:]))
+
     try:
         sys.argv.remove('--nolint')
     except ValueError:
@@ -14,13 +14,21 @@ setup(
     license='LGPL v3',
     url='https://github.com/txerpa/django-changuito',
     packages=['changuito'],
+    python_requires='>=3.6',
+    install_requires=['Django>=2.2,<4.0', 'asgiref>=3.2'],
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Environment :: Web Environment',
         'Framework :: Django',
+        'Framework :: Django :: 2.2',
+        'Framework :: Django :: 3.0',
+        'Framework :: Django :: 3.1',
+        'Framework :: Django :: 3.2',
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
 )
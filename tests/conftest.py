@@ -2,7 +2,11 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import os
+import tempfile
+
 import django
+import pytest
 from django.conf import settings
 
 
@@ -15,8 +19,18 @@ def pytest_configure():
             DATABASES={
                 'default': {
                     'ENGINE': 'django.db.backends.sqlite3',
-                    'NAME': ':memory:'
-                }
+                    'NAME': ':memory:',
+                    # A file so that tests can use it from several threads
+                    'TEST': {'NAME': os.path.join(
+                        tempfile.gettempdir(),
+                        'changuito-tests-{}.sqlite3'.format(os.getpid()))},
+                },
+                # Stands for a read replica in the routing tests, without
+                # replication so that stale reads show
+                'replica': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:',
+                },
             },
             INSTALLED_APPS=(
                 'django.contrib.auth',
@@ -28,9 +42,68 @@ def pytest_configure():
             SITE_ID=1,
             SECRET_KEY='this-is-just-for-tests-so-not-that-secret',
             MIDDLEWARE_CLASSES=(),
+            CART_ITEMS_FK=bool(os.environ.get('CHANGUITO_ITEMS_FK')),
         )
 
         try:
             django.setup()
         except AttributeError:
             pass
+
+
+@pytest.fixture
+def rqst():
+    from django.contrib.auth.models import AnonymousUser
+    from django.http import HttpRequest
+
+    r = HttpRequest()
+    r.session = {}
+    r.user = AnonymousUser()
+    return r
+
+
+@pytest.fixture
+def session():
+    return {}
+
+
+@pytest.fixture
+def new_request(session):
+    """Factory of new requests of the same ``session``."""
+    from django.contrib.auth.models import AnonymousUser
+    from django.test import RequestFactory
+
+    def make(user=None, **headers):
+        r = RequestFactory().get('/', **headers)
+        r.session = session
+        r.user = user or AnonymousUser()
+        return r
+    return make
+
+
+@pytest.fixture
+def new_proxy(new_request):
+    """Factory of lazy proxies of new requests of the same session."""
+    from changuito.proxy import CartProxy
+
+    def make(user=None):
+        return CartProxy(new_request(user), lazy=True)
+    return make
+
+
+@pytest.fixture
+def products():
+    from django.contrib.auth.models import User
+
+    return [User.objects.create(username='product_{}'.format(i))
+            for i in range(5)]
+
+
+@pytest.fixture
+def snapshots(settings):
+    from django.core.cache import cache
+
+    settings.CART_SNAPSHOT_CACHE = 'default'
+    cache.clear()
+    yield
+    cache.clear()
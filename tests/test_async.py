@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.http import HttpResponse
+
+from changuito.async_proxy import AsyncCartProxy, async_proxy_class
+from changuito.middleware import AsyncCartMiddleware
+from changuito.storage import CacheCartProxy
+
+
+@pytest.mark.django_db
+def test_async_proxy(rqst, products):
+    proxy = AsyncCartProxy(rqst, lazy=True)
+
+    async def view():
+        cart = await proxy.aget_cart()
+        item = await proxy.aadd_item(products[0], Decimal('10'), 2)
+        await proxy.aadd_items([(products[1], Decimal('5'), 1)])
+        await proxy.aupdate_item_quantity(products[1], 3)
+        items = [i.content_object async for i in proxy]
+        summary = await proxy.asummary()
+        await proxy.aremove_item(item.id)
+        total = await proxy.atotal_price()
+        await proxy.aclear_items()
+        empty = await proxy.ais_empty()
+        checked_out = await proxy.acheckout()
+        return cart, items, summary, total, empty, checked_out
+
+    cart, items, summary, total, empty, checked_out = async_to_sync(view)()
+    assert items == products[:2]
+    assert summary['total_price'] == 35
+    assert total == 15
+    assert empty is True
+    assert checked_out == cart and cart.checked_out is True
+
+
+def test_async_proxy_class():
+    proxy_class = async_proxy_class(CacheCartProxy)
+    assert issubclass(proxy_class, CacheCartProxy)
+    assert async_proxy_class(CacheCartProxy) is proxy_class
+    assert async_proxy_class(AsyncCartProxy) is AsyncCartProxy
+
+
+@pytest.mark.django_db
+def test_async_middleware(rqst, products, django_assert_num_queries):
+    async def get_response(request):
+        await request.cart.aadd_item(products[0], Decimal('1'))
+        return HttpResponse()
+
+    middleware = AsyncCartMiddleware(get_response)
+    async_to_sync(middleware)(rqst)
+    assert isinstance(rqst.cart, AsyncCartProxy)
+    assert rqst.cart.total_quantity() == 1
+
+    with django_assert_num_queries(0):
+        AsyncCartMiddleware(lambda request: HttpResponse())(rqst)
+    assert rqst.cart.is_resolved is False
+
+
+@pytest.mark.django_db
+def test_async_middleware_excluded_paths(settings, rqst):
+    settings.CART_MIDDLEWARE_EXCLUDE = ['/static/']
+    rqst.path_info = '/static/app.js'
+
+    async def get_response(request):
+        return HttpResponse()
+
+    async_to_sync(AsyncCartMiddleware(get_response))(rqst)
+    assert not hasattr(rqst, 'cart')
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+from decimal import Decimal
+
+import pytest
+from django.contrib.auth.models import User
+
+from changuito.exceptions import ItemDoesNotExist
+from changuito.views import cart_snapshot
+
+
+@pytest.mark.django_db
+def test_reads_are_memoized(new_proxy, products, django_assert_num_queries):
+    proxy = new_proxy()
+    item = proxy.add_item(products[0], Decimal('10'), 2)
+    with django_assert_num_queries(3):
+        for _ in range(3):
+            assert proxy.is_empty() is False
+            assert proxy.total_price() == 20
+            assert proxy.get_item(item.id).quantity == 2
+    proxy.add_item(products[0], Decimal('10'))
+    assert proxy.summary()['total_quantity'] == 3
+
+
+@pytest.mark.django_db
+def test_snapshot_is_shared_across_requests(snapshots, new_proxy, products,
+                                            django_assert_num_queries):
+    proxy = new_proxy()
+    item = proxy.add_item(products[0], Decimal('10'), 2)
+    proxy.add_item(products[1], Decimal('5'))
+    assert proxy.total_price() == 25
+
+    with django_assert_num_queries(0):
+        proxy = new_proxy()
+        assert proxy.is_empty() is False
+        assert proxy.summary() == {'total_price': Decimal('25'),
+                                   'total_quantity': Decimal('3'),
+                                   'item_count': 2}
+        assert proxy.get_item(item.id).quantity == 2
+        with pytest.raises(ItemDoesNotExist):
+            proxy.get_item(item.id + 100)
+    # Only the products are loaded
+    with django_assert_num_queries(1):
+        assert [i.content_object for i in proxy] == products[:2]
+    assert proxy.is_resolved is False
+
+
+@pytest.mark.django_db
+def test_changes_bump_the_version(snapshots, new_proxy, products):
+    new_proxy().add_item(products[0], Decimal('10'))
+    assert new_proxy().total_price() == 10
+
+    new_proxy().add_item(products[1], Decimal('5'))
+    proxy = new_proxy()
+    assert proxy.total_price() == 15
+
+    # Changes made without the proxy
+    list(proxy)[0].update_quantity(3)
+    assert new_proxy().total_price() == 35
+
+    new_proxy().clear_items()
+    assert new_proxy().is_empty() is True
+
+
+@pytest.mark.django_db
+def test_snapshot_of_another_user_is_ignored(snapshots, new_proxy, products):
+    new_proxy().add_item(products[0], Decimal('10'))
+    new_proxy().summary()
+    user = User.objects.create(username='buyer')
+    proxy = new_proxy(user)
+    assert proxy.is_empty() is True
+    assert proxy.cart.user == user
+
+
+@pytest.mark.django_db
+def test_new_cart_after_checkout(snapshots, new_request, new_proxy, products):
+    user = User.objects.create(username='buyer')
+    proxy = new_proxy(user)
+    proxy.add_item(products[0], Decimal('10'), 3)
+    cart = proxy.checkout()
+    # The checked-out cart is still read for the rest of the request
+    assert proxy.total_quantity() == 3
+
+    proxy = new_proxy(user)
+    assert proxy.total_quantity() == 0
+    assert proxy.is_empty() is True
+    assert list(proxy) == []
+    assert proxy.cart != cart
+    response = cart_snapshot(new_request(user))
+    assert json.loads(response.content)['item_count'] == 0
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import csv
+import json
+import os
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from changuito.exceptions import ItemIsDetached
+from changuito.export import export_lines
+from changuito.management.commands.repair_cart_totals import Command
+from changuito.models import ArchivedCart, Cart, Item, delete_carts
+
+
+@override_settings(CART_DENORMALIZED_TOTALS=True)
+class RepairCartTotalsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user_for_sell')
+        self.cart = Cart.objects.create()
+        item = Item.objects.create(content_object=self.user, quantity=3,
+                                   unit_price=Decimal('2.50'))
+        self.cart.items.add(item)
+        self.empty_cart = Cart.objects.create()
+
+    def test_repairs_drifted_totals(self):
+        out = StringIO()
+        call_command('repair_cart_totals', stdout=out)
+        self.assertIn('2 carts checked, 1 repaired', out.getvalue())
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.total_price(), Decimal('7.5'))
+        self.assertEqual(self.cart.total_quantity(), 3)
+        self.assertEqual(self.cart.item_count, 1)
+
+        out = StringIO()
+        call_command('repair_cart_totals', stdout=out)
+        self.assertIn('2 carts checked, 0 repaired', out.getvalue())
+
+    def test_changes_made_during_the_repair_are_kept(self):
+        drifted_carts = Command.drifted_carts
+        product = User.objects.create(username='product')
+
+        def add_item(carts):
+            drifted = drifted_carts(carts)
+            # Added by a request once the totals were read
+            self.cart.items.add(Item.objects.create(
+                content_object=product, quantity=1, unit_price=10))
+            self.cart.adjust_totals(10, 1, 1)
+            return drifted
+
+        with mock.patch.object(Command, 'drifted_carts',
+                               staticmethod(add_item)):
+            call_command('repair_cart_totals', stdout=StringIO())
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.total_price(), Decimal('17.5'))
+        self.assertEqual(self.cart.total_quantity(), 4)
+        self.assertEqual(self.cart.item_count, 2)
+        self.empty_cart.refresh_from_db()
+        self.assertEqual(self.empty_cart.item_count, 0)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('repair_cart_totals', '--dry-run', stdout=out)
+        self.assertIn('1 drifted', out.getvalue())
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.item_count, 0)
+
+
+class PurgeCartsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user_for_sell')
+        old = timezone.now() - timedelta(days=60)
+        self.abandoned = [Cart.objects.create(creation_date=old)
+                          for _ in range(5)]
+        self.abandoned_user = Cart.objects.create(creation_date=old,
+                                                  user=self.user)
+        self.checked_out = Cart.objects.create(creation_date=old,
+                                               checked_out=True)
+        self.recent = Cart.objects.create()
+        for cart in self.abandoned + [self.checked_out, self.recent]:
+            cart.items.add(Item.objects.create(
+                content_object=self.user, quantity=1, unit_price=1))
+
+    def test_purge(self):
+        out = StringIO()
+        call_command('purge_carts', '--batch-size', '2', stdout=out)
+        self.assertIn('Done, 6 carts deleted', out.getvalue())
+        self.assertEqual(set(Cart.objects.all()),
+                         {self.checked_out, self.recent})
+        self.assertEqual(Item.objects.count(), 2)
+
+    def test_carts_checked_out_during_the_purge_are_kept(self):
+        cart = self.abandoned[0]
+
+        def checkout_and_delete(carts, send_signals):
+            Cart.objects.filter(pk=cart.pk).update(checked_out=True)
+            return delete_carts(carts, send_signals)
+
+        with mock.patch('changuito.management.commands.purge_carts.'
+                        'delete_carts', checkout_and_delete):
+            call_command('purge_carts', stdout=StringIO())
+        self.assertEqual(set(Cart.objects.all()),
+                         {cart, self.checked_out, self.recent})
+        self.assertEqual(Item.objects.count(), 3)
+
+    def test_purge_skip_signals(self):
+        call_command('purge_carts', '--skip-signals', stdout=StringIO())
+        self.assertEqual(Cart.objects.count(), 2)
+        self.assertEqual(Item.objects.count(), 2)
+
+    def test_purge_anonymous_only(self):
+        call_command('purge_carts', '--anonymous-only', stdout=StringIO())
+        self.assertEqual(set(Cart.objects.all()),
+                         {self.abandoned_user, self.checked_out, self.recent})
+
+    def test_resume(self):
+        out = StringIO()
+        call_command('purge_carts', '--start-after', self.abandoned[2].pk,
+                     stdout=out)
+        self.assertIn('Done, 3 carts deleted', out.getvalue())
+        self.assertEqual(Cart.objects.filter(pk__lte=self.abandoned[2].pk)
+                         .count(), 3)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('purge_carts', '--dry-run', '--days', '90', stdout=out)
+        self.assertIn('0 carts would be deleted', out.getvalue())
+        call_command('purge_carts', '--dry-run', stdout=out)
+        self.assertIn('6 carts would be deleted', out.getvalue())
+
+
+class ArchiveCartsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user_for_sell')
+        old = timezone.now() - timedelta(days=60)
+        self.checked_out = [Cart.objects.create(creation_date=old,
+                                                checked_out=True, user=user)
+                            for user in (None, self.user, None)]
+        self.open = Cart.objects.create(creation_date=old)
+        self.recent = Cart.objects.create(checked_out=True)
+        for cart in self.checked_out + [self.open, self.recent]:
+            cart.items.add(Item.objects.create(
+                content_object=self.user, quantity=2, unit_price='1.50'))
+
+    def test_archive(self):
+        out = StringIO()
+        call_command('archive_carts', '--days', '30', '--batch-size', '2',
+                     stdout=out)
+        self.assertIn('Done, 3 carts archived', out.getvalue())
+        self.assertEqual(set(Cart.objects.all()), {self.open, self.recent})
+        self.assertEqual(Item.objects.count(), 2)
+        archived = ArchivedCart.objects.get(cart_id=self.checked_out[1].pk)
+        self.assertEqual(archived.user, self.user)
+        self.assertEqual(archived.creation_date,
+                         self.checked_out[1].creation_date)
+        self.assertEqual(archived.summary(), {'total_price': Decimal('3'),
+                                              'total_quantity': 2,
+                                              'item_count': 1})
+        [item] = archived.get_items()
+        self.assertEqual(item.content_object, self.user)
+        self.assertEqual(item.total_price, Decimal('3'))
+        self.assertIsNone(item.pk)
+        self.assertRaises(ItemIsDetached, item.update_quantity, 3)
+
+    def test_skip_signals(self):
+        call_command('archive_carts', '--skip-signals', stdout=StringIO())
+        self.assertEqual(ArchivedCart.objects.count(), 4)
+        self.assertEqual(set(Cart.objects.all()), {self.open})
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command('archive_carts', '--dry-run', '--days', '30', stdout=out)
+        self.assertIn('3 carts would be archived', out.getvalue())
+        self.assertEqual(ArchivedCart.objects.count(), 0)
+
+
+class RepriceOpenCartsTestCase(TestCase):
+
+    def setUp(self):
+        self.products = [User.objects.create(username='product_{}'.format(i))
+                         for i in range(2)]
+        self.carts = [Cart.objects.create(checked_out=checked_out)
+                      for checked_out in (False, False, True)]
+        for cart in self.carts:
+            for product in self.products:
+                cart.items.add(Item.objects.create(
+                    content_object=product, quantity=1, unit_price=1))
+
+    def test_reprice(self):
+        out = StringIO()
+        call_command('reprice_open_carts', 'auth.User',
+                     str(self.products[0].pk), '2.50', stdout=out)
+        self.assertIn('2 carts repriced', out.getvalue())
+        self.assertEqual(
+            sorted(Item.objects.values_list('unit_price', flat=True)),
+            [1] * 4 + [Decimal('2.50')] * 2)
+
+    def test_prices_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'prices.csv')
+        with open(path, 'w') as prices:
+            for product in self.products:
+                prices.write('auth.user,{},3\n'.format(product.pk))
+        out = StringIO()
+        call_command('reprice_open_carts', '--prices', path, stdout=out)
+        self.assertIn('2 carts repriced', out.getvalue())
+        self.assertEqual(Item.objects.filter(unit_price=3).count(), 4)
+
+    def test_errors(self):
+        with self.assertRaises(CommandError):
+            call_command('reprice_open_carts', stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('reprice_open_carts', 'shop.Nothing', '1', '2',
+                         stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command('reprice_open_carts', 'auth.User', '1', 'free',
+                         stdout=StringIO())
+
+
+class ExportCartsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user_for_sell')
+        self.cart = Cart.objects.create(user=self.user)
+        for quantity in (1, 2):
+            self.cart.items.add(Item.objects.create(
+                content_object=User.objects.create(
+                    username='product_{}'.format(quantity)),
+                quantity=quantity, unit_price=Decimal('2.50')))
+        self.empty = Cart.objects.create(checked_out=True)
+        self.old = Cart.objects.create(
+            creation_date=timezone.now() - timedelta(days=10))
+
+    def test_export_lines(self):
+        lines = list(export_lines(products=True))
+        self.assertEqual([line['cart_id'] for line in lines],
+                         [self.cart.pk, self.cart.pk, self.empty.pk,
+                          self.old.pk])
+        self.assertEqual(lines[1]['quantity'], 2)
+        self.assertEqual(lines[1]['product'], 'auth.user')
+        self.assertIsNone(lines[2]['item_id'])
+        self.assertIsNone(lines[2]['product'])
+
+    def test_filters(self):
+        today = timezone.now().date()
+        self.assertEqual(
+            set(line['cart_id'] for line in export_lines(since=today)),
+            {self.cart.pk, self.empty.pk})
+        self.assertEqual(
+            [line['cart_id'] for line in export_lines(
+                until=today - timedelta(days=1))], [self.old.pk])
+        self.assertEqual(
+            [line['cart_id'] for line in export_lines(checked_out=True)],
+            [self.empty.pk])
+
+    def test_streams_with_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(list(export_lines(chunk_size=1))), 4)
+
+    def test_csv(self):
+        out = StringIO()
+        call_command('export_carts', '--open', stdout=out)
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['user_id'], str(self.user.pk))
+        self.assertEqual(rows[0]['unit_price'], '2.50')
+
+    def test_jsonl(self):
+        out = StringIO()
+        call_command('export_carts', '--format', 'jsonl', '--checked-out',
+                     '--products', stdout=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['cart_id'], self.empty.pk)
+        self.assertIs(lines[0]['checked_out'], True)
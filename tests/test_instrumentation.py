@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+import pytest
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+
+from changuito.instrumentation import InMemorySink, get_sink
+from changuito.middleware import CartMiddleware
+from changuito.signals import cart_operation
+
+
+def _get_response(request):
+    return HttpResponse()
+
+
+@pytest.fixture
+def sink(settings):
+    settings.CART_INSTRUMENTATION = True
+    settings.CART_METRICS_SINK = 'changuito.instrumentation.InMemorySink'
+    sink = get_sink()
+    sink.reset()
+    return sink
+
+
+@pytest.mark.django_db
+def test_operations_are_measured(sink, rqst):
+    product = User.objects.create(username='product')
+    received = []
+
+    def receiver(sender, **kwargs):
+        received.append(kwargs['operation'])
+
+    cart_operation.connect(receiver)
+    try:
+        CartMiddleware(_get_response).process_request(rqst)
+        rqst.cart.add_item(product, Decimal('1'))
+        rqst.cart.add_item(product, Decimal('1'))
+        list(rqst.cart)
+        rqst.cart.summary()
+    finally:
+        cart_operation.disconnect(receiver)
+
+    assert received == ['middleware', 'get_cart', 'add_item', 'add_item',
+                        'iteration', 'totals']
+    stats = sink.stats('add_item')
+    assert stats['count'] == 2
+    assert stats['queries_p50'] > 0
+    assert stats['wall_time_p99'] >= stats['db_time_p99']
+    assert sink.stats('get_cart')['queries_p50'] == 1
+
+    summary = rqst.cart.metrics_summary()
+    assert summary['add_item']['count'] == 2
+    assert summary['totals']['queries'] == 1
+    assert set(summary) == {'middleware', 'get_cart', 'add_item',
+                            'iteration', 'totals'}
+
+
+@pytest.mark.django_db
+def test_totals_are_measured(sink, new_proxy):
+    proxy = new_proxy()
+    proxy.total_price()
+    proxy.total_quantity()
+    assert [metric[0] for metric in proxy.metrics].count('totals') == 2
+
+
+@pytest.mark.django_db
+def test_disabled_by_default(rqst):
+    CartMiddleware(_get_response).process_request(rqst)
+    rqst.cart.is_empty()
+    assert rqst.cart.metrics == []
+
+
+def test_in_memory_sink_percentiles():
+    sink = InMemorySink()
+    for n in range(1, 101):
+        sink.record('add_item', n, n / 1000.0, n / 100.0)
+    stats = sink.stats('add_item')
+    assert (stats['queries_p50'], stats['queries_p95'],
+            stats['queries_p99']) == (50, 95, 99)
+    assert stats['count'] == 100
+    assert sink.stats('checkout') is None
@@ -2,18 +2,27 @@
 
 from __future__ import absolute_import, unicode_literals
 
-from django.contrib.auth.models import AnonymousUser
-from django.http import HttpRequest
-from django.test import TestCase
+import re
+from decimal import Decimal
 
-from changuito.middleware import CartMiddleware
-from changuito.proxy import CartProxy
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase, override_settings
+
+from changuito.exceptions import ItemDoesNotExist
+from changuito.middleware import CartMiddleware, handles_path
+from changuito.models import Cart
+from changuito.proxy import CART_ID, CartProxy
+
+
+def _get_response(request):
+    return HttpResponse()
 
 
 class CartMiddlewareTestCase(TestCase):
 
     def setUp(self):
-        self.cm = CartMiddleware()
+        self.cm = CartMiddleware(_get_response)
         r = HttpRequest()
         r.session = {}
         r.user = AnonymousUser()
@@ -22,3 +31,88 @@ class CartMiddlewareTestCase(TestCase):
     def test_process_request_without_cart(self):
         self.assertEqual(self.cm.process_request(self.request), None)
         self.assertIsInstance(self.request.cart, CartProxy)
+
+    def test_process_request_is_lazy(self):
+        with self.assertNumQueries(0):
+            self.cm.process_request(self.request)
+        self.assertFalse(self.request.cart.is_resolved)
+        self.assertNotIn(CART_ID, self.request.session)
+        self.assertEqual(Cart.objects.count(), 0)
+
+    def test_lazy_cart_is_stored_on_first_use(self):
+        self.cm.process_request(self.request)
+        cart = self.request.cart.cart
+        self.assertTrue(self.request.cart.is_resolved)
+        self.assertEqual(self.request.session[CART_ID], cart.id)
+
+    def test_reads_do_not_create_the_cart(self):
+        self.cm.process_request(self.request)
+        proxy = self.request.cart
+        with self.assertNumQueries(0):
+            self.assertTrue(proxy.is_empty())
+            self.assertEqual(proxy.total_price(), 0)
+            self.assertEqual(proxy.summary()['item_count'], 0)
+            self.assertEqual(list(proxy), [])
+            self.assertEqual(proxy.snapshot()['lines'], [])
+            self.assertEqual(proxy.version(), '0-0')
+            with self.assertRaises(ItemDoesNotExist):
+                proxy.get_item(1)
+        self.assertFalse(proxy.is_resolved)
+        self.assertEqual(self.request.session, {})
+        self.assertEqual(Cart.objects.count(), 0)
+
+        # Logged-in users without an open cart need the query looking it up
+        self.request.user = User.objects.create(username='buyer')
+        proxy = CartProxy(self.request, lazy=True)
+        with self.assertNumQueries(1):
+            self.assertTrue(proxy.is_empty())
+            self.assertEqual(list(proxy), [])
+        self.assertEqual(Cart.objects.count(), 0)
+
+        proxy.add_item(self.request.user, Decimal('10'))
+        self.assertEqual(proxy.total_price(), 10)
+        self.assertEqual(self.request.session[CART_ID], proxy.cart.id)
+
+    def test_lazy_cart_reuses_session_cart(self):
+        cart = Cart.objects.create()
+        self.request.session[CART_ID] = cart.id
+        self.cm.process_request(self.request)
+        self.assertEqual(self.request.cart.cart, cart)
+        self.assertEqual(Cart.objects.count(), 1)
+
+    @override_settings(CART_LAZY=False)
+    def test_process_request_eager(self):
+        self.cm.process_request(self.request)
+        self.assertTrue(self.request.cart.is_resolved)
+        self.assertEqual(self.request.session[CART_ID],
+                         self.request.cart.cart.id)
+
+    def test_request_body_is_not_read(self):
+        self.request.method = 'POST'
+        self.request.META['CONTENT_TYPE'] = 'multipart/form-data'
+        response = self.cm(self.request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(self.request.cart, CartProxy)
+        self.assertNotIn('_post', self.request.__dict__)
+
+    @override_settings(CART_MIDDLEWARE_EXCLUDE=[
+        '/static/', re.compile(r'^/api/v\d+/health')])
+    def test_excluded_paths(self):
+        for path, handled in (('/static/app.js', False),
+                              ('/api/v2/health', False),
+                              ('/api/v2/cart', True),
+                              ('/shop/', True)):
+            request = HttpRequest()
+            request.path_info = path
+            request.session = {}
+            request.user = AnonymousUser()
+            with self.assertNumQueries(0):
+                self.cm(request)
+            self.assertEqual(hasattr(request, 'cart'), handled, path)
+
+    @override_settings(CART_MIDDLEWARE_INCLUDE=['/shop/'],
+                       CART_MIDDLEWARE_EXCLUDE=['/shop/static/'])
+    def test_included_paths(self):
+        self.assertTrue(handles_path('/shop/cart'))
+        self.assertFalse(handles_path('/shop/static/app.js'))
+        self.assertFalse(handles_path('/blog/'))
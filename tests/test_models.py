@@ -7,9 +7,14 @@ from decimal import Decimal
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest import mock, skipIf
 
-from changuito.models import Cart, Item
+from changuito.models import (Cart, Item, items_fk, reprice_open_carts,
+                              reprice_products)
+from changuito.products import ProductKey, get_content_type_id
 
 try:
     from django.utils import timezone
@@ -54,6 +59,7 @@ class CartItemsTestCase(TestCase):
                           'The first item in cart should'
                           ' have 2 in it\'s quantity')
 
+    @skipIf(items_fk, 'Carts have one line per product with CART_ITEMS_FK')
     def test_cart_total_price(self):
         self._create_item_in_db(content_object=self.user)
         self._create_item_in_db(content_object=self.user,
@@ -84,6 +90,7 @@ class CartItemsTestCase(TestCase):
         item.update_quantity(7)
         self.assertEquals(item.quantity, 7)
 
+    @skipIf(items_fk, 'Carts have one line per product with CART_ITEMS_FK')
     def test_item_update_contenttype(self):
         obj_site = Site.objects.all()[:1]
         obj_user = User()
@@ -111,3 +118,107 @@ class CartItemsTestCase(TestCase):
         item.update_price(137)
 
         self.assertEquals(item.unit_price, 137)
+
+    def test_cart_summary(self):
+        obj_site = Site.objects.all()[:1]
+        self._create_item_in_db(content_object=self.user,
+                                unit_price=Decimal('3.20'), quantity=4)
+        self._create_item_in_db(content_object=obj_site[0],
+                                unit_price=Decimal('100.00'), quantity=1)
+        with self.assertNumQueries(1):
+            summary = self.cart.summary()
+        self.assertEqual(summary, {'total_price': Decimal('112.80'),
+                                   'total_quantity': Decimal('5'),
+                                   'item_count': 2})
+        self.assertIsInstance(self.cart.total_price(), Decimal)
+
+    def test_empty_cart_summary(self):
+        self.assertEqual(self.cart.summary(), {'total_price': Decimal('0'),
+                                               'total_quantity': Decimal('0'),
+                                               'item_count': 0})
+
+
+class PartialIndexTestCase(TestCase):
+
+    def _index_sql(self):
+        index, = [index for index in Cart._meta.indexes
+                  if index.name == 'changuito_cart_user_open']
+        editor = connection.SchemaEditorClass(connection, collect_sql=True)
+        return str(index.create_sql(Cart, editor))
+
+    def test_partial_where_supported(self):
+        sql = self._index_sql()
+        self.assertIn('WHERE', sql)
+        self.assertIn('("user_id", "creation_date")', sql)
+
+    def test_full_index_as_fallback(self):
+        with mock.patch.object(connection.features,
+                               'supports_partial_indexes', False):
+            sql = self._index_sql()
+        self.assertNotIn('WHERE', sql)
+        self.assertIn('("user_id", "checked_out", "creation_date")', sql)
+
+
+class RepriceTestCase(TestCase):
+
+    def setUp(self):
+        self.products = [User.objects.create(username='product_{}'.format(i))
+                         for i in range(3)]
+        self.site = Site.objects.get_current()
+        self.open = [Cart.objects.create() for _ in range(3)]
+        self.checked_out = Cart.objects.create(checked_out=True)
+        for cart in self.open + [self.checked_out]:
+            for product in self.products[:2] + [self.site]:
+                self._add(cart, product, quantity=2, unit_price=10)
+
+    def _add(self, cart, product, quantity, unit_price):
+        item = Item.objects.create(content_object=product, quantity=quantity,
+                                   unit_price=unit_price)
+        cart.items.add(item)
+        return item
+
+    def _prices(self, cart, product):
+        return list(cart.items.filter(
+            content_type_id=get_content_type_id(product),
+            object_id=product.pk).values_list('unit_price', flat=True))
+
+    def test_reprice_open_carts(self):
+        self.assertEqual(reprice_open_carts(self.products[0],
+                                            Decimal('12.50')), 3)
+        for cart in self.open:
+            self.assertEqual(self._prices(cart, self.products[0]),
+                             [Decimal('12.50')])
+            self.assertEqual(self._prices(cart, self.products[1]),
+                             [Decimal('10')])
+        self.assertEqual(self._prices(self.checked_out, self.products[0]),
+                         [Decimal('10')])
+        # Already at that price
+        self.assertEqual(reprice_open_carts(self.products[0],
+                                            Decimal('12.50')), 0)
+
+    def test_reprice_products(self):
+        self._add(Cart.objects.create(), self.products[2], 1, 5)
+        key = ProductKey(get_content_type_id(Site), self.site.pk)
+        prices = {self.products[0]: Decimal('1'),
+                  self.products[1]: Decimal('2'),
+                  self.products[2]: Decimal('3'),
+                  key: Decimal('4')}
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(reprice_products(prices), 4)
+        # A SELECT and an UPDATE per content type, and an UPDATE of the
+        # versions of the carts, in a transaction
+        self.assertLessEqual(len(captured), 7)
+        for cart in self.open:
+            self.assertEqual(cart.total_price(), Decimal('14'))
+
+    @override_settings(CART_DENORMALIZED_TOTALS=True)
+    def test_stored_totals(self):
+        Cart.objects.update(stored_total_price=60, stored_total_quantity=6,
+                            item_count=3)
+        reprice_open_carts(self.site, Decimal('1'))
+        for cart in self.open:
+            cart.refresh_from_db()
+            self.assertEqual(cart.total_price(), Decimal('42'))
+            self.assertEqual(cart.total_quantity(), 6)
+        self.checked_out.refresh_from_db()
+        self.assertEqual(self.checked_out.total_price(), Decimal('60'))
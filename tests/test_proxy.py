@@ -2,22 +2,28 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import threading
 from decimal import Decimal
+from io import StringIO
+
 import pytest
 
+from django.contrib.auth import user_logged_in
 from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.signals import post_delete
 from django.http import HttpRequest
+from django.test.utils import CaptureQueriesContext
 
-from changuito.models import Item
+from changuito.models import Cart, Item
+from changuito.products import (ProductKey, get_content_type_id,
+                                get_product_model, product_key)
 from changuito.proxy import CART_ID, CartProxy
-from changuito.exceptions import CartDoesNotExist, ItemDoesNotExist
-
-
-@pytest.fixture
-def rqst():
-    r = HttpRequest()
-    r.session = {}
-    return r
+from changuito.exceptions import (CartAlreadyCheckedOut, CartDoesNotExist,
+                                  ItemDoesNotExist)
 
 
 @pytest.fixture
@@ -67,6 +73,60 @@ def test_cart_clear(cart_proxy_anonuser, user, rqst):
     assert cart_proxy_anonuser.is_empty() is True
 
 
+@pytest.fixture
+def item_deletions():
+    deleted = []
+
+    def receiver(sender, instance, **kwargs):
+        deleted.append(instance.pk)
+    post_delete.connect(receiver, sender=Item)
+    yield deleted
+    post_delete.disconnect(receiver, sender=Item)
+
+
+@pytest.mark.django_db
+def test_cart_clear_in_constant_queries(cart_proxy_anonuser, products,
+                                        item_deletions,
+                                        django_assert_max_num_queries):
+    cart_proxy_anonuser.add_items([(product, Decimal('1'), 1)
+                                   for product in products])
+    # The lock and a DELETE per table, in a savepoint here
+    with django_assert_max_num_queries(6):
+        cart_proxy_anonuser.clear_items(send_signals=False)
+    assert cart_proxy_anonuser.is_empty() is True
+    assert item_deletions == []
+    assert Item.objects.count() == 0
+
+    cart_proxy_anonuser.add_items([(product, Decimal('1'), 1)
+                                   for product in products])
+    cart_proxy_anonuser.clear_items()
+    assert len(item_deletions) == len(products)
+    assert Item.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_cart_delete_removes_items(cart_proxy_anonuser, products):
+    cart_proxy_anonuser.add_items([(product, Decimal('1'), 1)
+                                   for product in products])
+    cart_proxy_anonuser.cart.delete()
+    assert Item.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_delete_user_last_cart(user, rqst, products):
+    rqst.user = user
+    cart_proxy = CartProxy(rqst)
+    cart_proxy.add_item(products[0], Decimal('1'))
+    order = cart_proxy.checkout()
+    cart_proxy = CartProxy(rqst)
+    cart_proxy.add_item(products[1], Decimal('1'))
+    CartProxy.delete_user_last_cart(user, send_signals=False)
+    assert list(Cart.objects.filter(user=user)) == [order]
+    assert [item.object_id for item in Item.objects.all()] == [products[0].pk]
+    CartProxy.delete_user_last_cart(user)
+    assert list(Cart.objects.filter(user=user)) == [order]
+
+
 @pytest.mark.django_db
 def test_cart_add_item(cart_proxy_anonuser, user):
     _create_item_in_request(cart_proxy_anonuser, user)
@@ -123,6 +183,18 @@ def test_new_cart_after_checkout_user(rqst, user):
     assert cart_proxy2.cart.checked_out is False
 
 
+@pytest.mark.django_db
+def test_new_cart_after_purge(new_proxy, session, products):
+    new_proxy().add_item(products[0], Decimal('1'))
+    purged = session[CART_ID]
+    call_command('purge_carts', '--days', '0', stdout=StringIO())
+    proxy = new_proxy()
+    assert proxy.is_empty() is True
+    proxy.add_item(products[1], Decimal('1'))
+    assert session[CART_ID] == proxy.cart.pk != purged
+    assert [item.content_object for item in proxy] == products[1:2]
+
+
 @pytest.mark.django_db
 def test_cart_remove_unexistent_item(cart_proxy_anonuser):
     with pytest.raises(ItemDoesNotExist):
@@ -148,6 +220,18 @@ def test_user_n_carts(user, rqst):
     assert cart_proxy.n_carts(user) == 2
 
 
+@pytest.mark.django_db
+def test_user_n_carts_with_archived_carts(settings, user, rqst, products):
+    settings.CART_ARCHIVE_ON_CHECKOUT = True
+    rqst.user = user
+    cart_proxy = CartProxy(rqst)
+    cart_proxy.add_item(products[0], Decimal('10'))
+    cart_proxy.checkout()
+    CartProxy(rqst).add_item(products[0], Decimal('10'))
+    assert CartProxy.n_carts(user) == 2
+    assert CartProxy.archived_carts(user).count() == 1
+
+
 @pytest.mark.django_db
 def test_get_user_last_cart(user, rqst):
     rqst.user = user
@@ -163,3 +247,424 @@ def test_get_user_last_cart(user, rqst):
 def test_get_user_unexistent_last_cart_(user):
     with pytest.raises(CartDoesNotExist):
         CartProxy.get_user_last_cart(user)
+
+
+@pytest.mark.django_db
+def test_cart_add_items(cart_proxy_anonuser, products):
+    _create_item_in_db(cart_proxy_anonuser.cart, content_object=products[0])
+    lines = [(product, Decimal('10'), 1) for product in products]
+    lines.append((products[1], Decimal('10'), 2))
+    items = cart_proxy_anonuser.add_items(lines)
+    assert len(items) == 5
+    quantities = dict((item.object_id, item.quantity)
+                      for item in cart_proxy_anonuser.cart.items.all())
+    assert quantities[products[0].id] == 3
+    assert quantities[products[1].id] == 3
+    assert quantities[products[2].id] == 1
+    assert cart_proxy_anonuser.cart.items.count() == 5
+
+
+@pytest.mark.django_db
+def test_cart_set_quantities(cart_proxy_anonuser, products):
+    cart_proxy_anonuser.add_items([(product, Decimal('10'), 4)
+                                   for product in products[:2]])
+    cart_proxy_anonuser.set_quantities([(products[0], Decimal('10'), 1),
+                                        (products[2], Decimal('10'), 5)])
+    quantities = dict((item.object_id, item.quantity)
+                      for item in cart_proxy_anonuser.cart.items.all())
+    assert quantities == {products[0].id: 1, products[1].id: 4,
+                          products[2].id: 5}
+
+
+@pytest.mark.django_db
+def test_cart_add_items_updates_in_constant_queries(
+        cart_proxy_anonuser, products, django_assert_num_queries):
+    lines = [(product, Decimal('10'), 1) for product in products]
+    cart_proxy_anonuser.add_items(lines)
+    # The lock, one read and one bulk update, whatever the number of lines
+    with django_assert_num_queries(5):
+        cart_proxy_anonuser.add_items(lines)
+    assert cart_proxy_anonuser.cart.total_quantity() == 10
+
+
+@pytest.fixture
+def denormalized(settings):
+    settings.CART_DENORMALIZED_TOTALS = True
+
+
+def _assert_stored_totals(cart_proxy):
+    cart = cart_proxy.cart
+    cart.refresh_from_db()
+    items = list(cart.items.all())
+    assert cart.stored_total_price == sum(i.total_price for i in items)
+    assert cart.stored_total_quantity == sum(i.quantity for i in items)
+    assert cart.item_count == len(items)
+
+
+@pytest.mark.django_db
+def test_denormalized_totals(denormalized, cart_proxy_anonuser, products):
+    cart_proxy_anonuser.add_item(products[0], Decimal('2.50'), 2)
+    cart_proxy_anonuser.add_item(products[0], Decimal('2.50'), 1)
+    item = cart_proxy_anonuser.add_item(products[1], Decimal('10'), 1)
+    assert cart_proxy_anonuser.cart.total_price() == Decimal('17.5')
+    assert cart_proxy_anonuser.cart.total_quantity() == 4
+    _assert_stored_totals(cart_proxy_anonuser)
+
+    cart_proxy_anonuser.update_item_quantity(products[1], 4)
+    _assert_stored_totals(cart_proxy_anonuser)
+    cart_proxy_anonuser.remove_item(item.id)
+    _assert_stored_totals(cart_proxy_anonuser)
+    cart_proxy_anonuser.add_items([(product, Decimal('1'), 2)
+                                   for product in products])
+    _assert_stored_totals(cart_proxy_anonuser)
+    cart_proxy_anonuser.set_quantities([(products[0], Decimal('1'), 1)])
+    _assert_stored_totals(cart_proxy_anonuser)
+
+    item = cart_proxy_anonuser.cart.items.all()[0]
+    item.update_quantity(9)
+    _assert_stored_totals(cart_proxy_anonuser)
+    item.update_price(Decimal('3.25'))
+    _assert_stored_totals(cart_proxy_anonuser)
+
+    cart_proxy_anonuser.clear_items()
+    _assert_stored_totals(cart_proxy_anonuser)
+    assert cart_proxy_anonuser.cart.total_price() == 0
+
+
+@pytest.mark.django_db
+def test_denormalized_totals_of_floats_and_strings(
+        denormalized, cart_proxy_anonuser, products):
+    cart_proxy_anonuser.add_item(products[0], 2.5, 2)
+    cart_proxy_anonuser.add_item(products[0], '2.50', 1.5)
+    cart_proxy_anonuser.add_items([(products[1], '10', '1')])
+    cart_proxy_anonuser.update_item_quantity(products[1], 2.0)
+    _assert_stored_totals(cart_proxy_anonuser)
+    item = cart_proxy_anonuser.cart.items.get(object_id=products[0].pk)
+    item.update_quantity('4')
+    item.update_price(1.25)
+    _assert_stored_totals(cart_proxy_anonuser)
+    assert cart_proxy_anonuser.cart.total_price() == Decimal('25')
+    assert cart_proxy_anonuser.cart.total_quantity() == 6
+
+
+@pytest.mark.django_db
+def test_cart_iteration_prefetches_products(cart_proxy_anonuser, products,
+                                            django_assert_num_queries):
+    site = Site.objects.get_current()
+    ContentType.objects.get_for_models(User, Site)
+    cart_proxy_anonuser.add_items([(product, Decimal('1'), 1)
+                                   for product in products])
+    cart_proxy_anonuser.add_item(site, Decimal('1'))
+    # The items, then one query per product content type
+    with django_assert_num_queries(3):
+        objects = [item.content_object for item in cart_proxy_anonuser]
+    assert objects == products + [site]
+    with django_assert_num_queries(0):
+        assert len(list(cart_proxy_anonuser)) == 6
+
+    cart_proxy_anonuser.remove_item(list(cart_proxy_anonuser)[0].id)
+    assert len(list(cart_proxy_anonuser)) == 5
+
+
+@pytest.mark.django_db
+def test_items_with_products_hints(cart_proxy_anonuser, products,
+                                   django_assert_num_queries):
+    cart_proxy_anonuser.add_item(products[0], Decimal('1'))
+    items = cart_proxy_anonuser.items_with_products(only={User: ['username']})
+    with django_assert_num_queries(0):
+        assert items[0].content_object.username == products[0].username
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_add_item(products):
+    cart = CartProxy.new_cart()
+    threads, errors = [], []
+
+    def add_items():
+        try:
+            rqst = HttpRequest()
+            rqst.session = {CART_ID: cart.id}
+            rqst.user = AnonymousUser()
+            proxy = CartProxy(rqst)
+            for _ in range(10):
+                for product in products[:2]:
+                    proxy.add_item(product, Decimal('1'))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    for _ in range(8):
+        threads.append(threading.Thread(target=add_items))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    quantities = sorted((item.object_id, item.quantity)
+                        for item in cart.items.all())
+    assert quantities == [(products[0].id, 80), (products[1].id, 80)]
+
+
+@pytest.mark.django_db
+def test_add_item_by_product_key(cart_proxy_anonuser, products):
+    key = product_key(products[0])
+    assert key == ProductKey(get_content_type_id(User), products[0].id)
+    cart_proxy_anonuser.add_item(key, Decimal('2'))
+    cart_proxy_anonuser.add_items([(key, Decimal('2'), 2),
+                                   (products[1], Decimal('3'), 1)])
+    cart_proxy_anonuser.update_item_quantity(ProductKey(*key), 5)
+    assert [(item.content_object, item.quantity)
+            for item in cart_proxy_anonuser] == [(products[0], 5),
+                                                 (products[1], 1)]
+
+
+@pytest.mark.django_db
+def test_content_type_ids_are_cached(django_assert_num_queries):
+    get_content_type_id(User)
+    with django_assert_num_queries(0):
+        assert get_content_type_id(User()) == \
+            ContentType.objects.get_for_model(User).id
+        assert get_product_model(get_content_type_id(Site)) is Site
+
+
+def _fill(cart, lines):
+    proxy = CartProxy(HttpRequest(), lazy=True)
+    proxy.cart = cart
+    proxy.add_items(lines)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('policy,quantities', [
+    ('sum', [3, 1, 1]),
+    ('max', [3, 1, 1]),
+    ('keep-user', [2, 1, 1]),
+])
+def test_merge_carts(denormalized, user, products, policy, quantities):
+    source, target = CartProxy.new_cart(), CartProxy.new_cart(user=user)
+    _fill(source, [(products[0], Decimal('1'), 1),
+                   (products[1], Decimal('1'), 1)])
+    _fill(target, [(products[0], Decimal('5'), 2),
+                   (products[2], Decimal('1'), 1)])
+    if policy == 'max':
+        _fill(source, [(products[0], Decimal('1'), 2)])
+    cart = CartProxy.merge_carts(source, target, policy)
+    assert not Cart.objects.filter(pk=source.pk).exists()
+    assert Item.objects.count() == 3
+    lines = dict((item.object_id, (item.quantity, item.unit_price))
+                 for item in cart.items.all())
+    assert lines == {products[0].pk: (quantities[0], 5),
+                     products[1].pk: (quantities[1], 1),
+                     products[2].pk: (quantities[2], 1)}
+    cart.refresh_from_db()
+    assert cart.stored_total_price == quantities[0] * 5 + 2
+    assert cart.item_count == 3
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('checked_out', ['source', 'target'])
+def test_merge_checked_out_carts(user, products, checked_out):
+    source, target = CartProxy.new_cart(), CartProxy.new_cart(user=user)
+    _fill(source, [(products[0], Decimal('1'), 1)])
+    _fill(target, [(products[1], Decimal('1'), 1)])
+    carts = {'source': source, 'target': target}
+    Cart.objects.filter(pk=carts[checked_out].pk).update(checked_out=True)
+    with pytest.raises(CartAlreadyCheckedOut):
+        CartProxy.merge_carts(source, target)
+    assert Cart.objects.filter(pk=source.pk).exists()
+    assert [item.content_object for item in source.items.all()] == \
+        products[:1]
+    assert [item.content_object for item in target.items.all()] == \
+        products[1:2]
+
+
+@pytest.mark.django_db
+def test_merge_carts_in_constant_queries(user):
+    products = [User.objects.create(username='product_{}'.format(i))
+                for i in range(40)]
+    counts = []
+    for size in (2, 20):
+        source, target = CartProxy.new_cart(), CartProxy.new_cart(user=user)
+        _fill(source, [(product, Decimal('1'), 1)
+                       for product in products[:size]])
+        _fill(target, [(product, Decimal('1'), 1)
+                       for product in products[size // 2:size * 2]])
+        with CaptureQueriesContext(connection) as captured:
+            CartProxy.merge_carts(source, target)
+        counts.append(len(captured))
+        assert target.summary()['total_quantity'] == size * 2 + size // 2
+    assert counts[0] == counts[1]
+
+
+@pytest.mark.django_db
+def test_merge_on_login(user, rqst, products):
+    rqst.user = AnonymousUser()
+    anonymous = CartProxy(rqst, lazy=True)
+    anonymous.add_item(products[0], Decimal('1'), 2)
+    user_cart = CartProxy.new_cart(user=user)
+    _fill(user_cart, [(products[0], Decimal('1'), 1)])
+
+    rqst.user = user
+    user_logged_in.send(sender=User, request=rqst, user=user)
+    assert rqst.cart.cart == user_cart
+    assert rqst.session[CART_ID] == user_cart.pk
+    assert user_cart.total_quantity() == 3
+    assert Cart.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_anonymous_cart_is_given_on_login(settings, user, rqst, products):
+    rqst.user = AnonymousUser()
+    anonymous = CartProxy(rqst, lazy=True)
+    anonymous.add_item(products[0], Decimal('1'))
+    rqst.user = user
+    user_logged_in.send(sender=User, request=rqst, user=user)
+    assert CartProxy.get_user_last_cart(user) == anonymous.cart
+
+    settings.CART_MERGE_POLICY = None
+    other = User.objects.create(username='other')
+    rqst.user = AnonymousUser()
+    rqst.session = {}
+    CartProxy(rqst, lazy=True).add_item(products[0], Decimal('1'))
+    user_logged_in.send(sender=User, request=rqst, user=other)
+    assert CartProxy.n_carts(other) == 0
+
+
+@pytest.mark.django_db
+def test_checkout_reprices_in_bulk(cart_proxy_anonuser, products):
+    cart_proxy_anonuser.add_items([(product, Decimal('10'), 2)
+                                   for product in products])
+    calls = []
+
+    def pricing(keys):
+        calls.append(keys)
+        return {keys[0]: Decimal('7.50'), keys[1]: Decimal('10')}
+
+    cart = cart_proxy_anonuser.checkout(pricing=pricing)
+    assert len(calls) == 1
+    assert sorted(calls[0]) == sorted(
+        ProductKey(get_content_type_id(User), product.pk)
+        for product in products)
+    prices = sorted(item.unit_price for item in cart.items.all())
+    assert prices == [Decimal('7.50')] + [Decimal('10')] * 4
+    cart.refresh_from_db()
+    assert cart.checked_out is True
+    assert cart.stored_total_price == Decimal('95')
+    assert cart.stored_total_quantity == 10
+    assert cart.item_count == 5
+
+
+@pytest.mark.django_db
+def test_checkout_in_bounded_queries(user, rqst):
+    products = [User.objects.create(username='product_{}'.format(i))
+                for i in range(30)]
+    counts = []
+    for size in (3, 30):
+        proxy = CartProxy(rqst, lazy=True)
+        proxy.cart = CartProxy.new_cart()
+        proxy.add_items([(product, Decimal('10'), 1)
+                         for product in products[:size]])
+        with CaptureQueriesContext(connection) as captured:
+            proxy.checkout(pricing=lambda keys: dict(
+                (key, Decimal('9')) for key in keys))
+        counts.append(len(captured))
+        assert proxy.cart.total_price() == size * 9
+    assert counts[0] == counts[1]
+
+
+@pytest.mark.django_db
+def test_no_changes_after_checkout(new_proxy, products):
+    proxy = new_proxy()
+    proxy.add_items([(product, Decimal('10'), 1) for product in products[:2]])
+    stale = new_proxy()
+    item = stale.get_item(list(stale)[0].pk)
+    proxy.checkout()
+
+    changes = [
+        lambda: stale.add_item(products[2], Decimal('10')),
+        lambda: stale.add_item(products[0], Decimal('10')),
+        lambda: stale.add_items([(products[0], Decimal('10'), 1)]),
+        lambda: stale.update_item_quantity(products[0], 5),
+        lambda: stale.remove_item(item.pk),
+        lambda: stale.clear_items(),
+        lambda: stale.checkout(),
+    ]
+    for change in changes:
+        with pytest.raises(CartAlreadyCheckedOut):
+            change()
+    assert stale.cart.checked_out is True
+    assert sorted((item.object_id, item.quantity)
+                  for item in proxy.cart.items.all()) == [
+        (products[0].pk, 1), (products[1].pk, 1)]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_changes_and_checkout(products):
+    cart = CartProxy.new_cart()
+    proxies, errors = [], []
+    for _ in range(6):
+        rqst = HttpRequest()
+        rqst.session = {CART_ID: cart.id}
+        rqst.user = AnonymousUser()
+        proxies.append(CartProxy(rqst))
+
+    def change(proxy, index):
+        try:
+            for _ in range(20):
+                if index % 2:
+                    proxy.add_item(products[index % 3], Decimal('1'))
+                else:
+                    proxy.add_items([(products[3], Decimal('1'), 1)])
+        except CartAlreadyCheckedOut:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def checkout(proxy):
+        try:
+            proxy.checkout()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=change, args=(proxy, index))
+               for index, proxy in enumerate(proxies[1:])]
+    threads.insert(len(threads) // 2,
+                   threading.Thread(target=checkout, args=(proxies[0],)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    # Nothing was added once the totals of the checkout were computed
+    cart.refresh_from_db()
+    assert cart.checked_out is True
+    assert cart.compute_summary()['total_quantity'] == \
+        cart.stored_total_quantity
+
+
+@pytest.mark.django_db
+def test_checkout_archives_the_cart(settings, cart_proxy_anonuser, user,
+                                    products):
+    settings.CART_ARCHIVE_ON_CHECKOUT = True
+    cart_proxy_anonuser.add_items([(product, Decimal('10'), 2)
+                                   for product in products[:2]])
+    cart = cart_proxy_anonuser.checkout()
+    assert not Cart.objects.filter(pk=cart.pk).exists()
+    assert Item.objects.count() == 0
+
+    archived = CartProxy.get_archived_cart(cart.pk)
+    assert archived.checked_out is True
+    assert archived.total_price() == 40
+    assert archived.total_quantity() == 4
+    assert [item.content_object for item in
+            CartProxy.archived_items(archived)] == products[:2]
+    assert list(CartProxy.archived_carts(None)) == [archived]
+    assert list(CartProxy.archived_carts(user)) == []
+    with pytest.raises(CartDoesNotExist):
+        CartProxy.get_archived_cart(cart.pk + 1)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+import pytest
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.test.utils import CaptureQueriesContext
+
+from changuito.models import Cart, Item
+from changuito.proxy import CART_ID, CartProxy
+from changuito.routers import CartRouter, is_pinned, pin_cart
+
+pytestmark = pytest.mark.django_db(databases=['default', 'replica'],
+                                   transaction=True)
+
+
+@pytest.fixture
+def routed(settings):
+    settings.DATABASE_ROUTERS = ['changuito.routers.CartRouter']
+    settings.CART_READ_DATABASE = 'replica'
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture
+def replicated(session):
+    # A cart of the session replicated without its items, as by a lagging
+    # replica
+    cart = CartProxy.new_cart()
+    Cart.objects.using('replica').create(pk=cart.pk,
+                                         creation_date=cart.creation_date)
+    session[CART_ID] = cart.pk
+    return cart
+
+
+def test_router(routed):
+    router = CartRouter()
+    assert router.db_for_read(Cart) == 'replica'
+    assert router.db_for_read(Item) == 'replica'
+    assert router.db_for_write(Item) == 'default'
+    assert router.db_for_read(User) is None
+    assert router.db_for_write(User) is None
+    with transaction.atomic():
+        assert router.db_for_read(Item) == 'default'
+    cart = Cart.objects.using('default').create()
+    assert router.db_for_read(Item, instance=cart) == 'default'
+    cart = Cart.objects.using('replica').create()
+    assert router.db_for_read(Item, instance=cart) == 'replica'
+    pin_cart(cart)
+    assert router.db_for_read(Item, instance=cart) == 'default'
+    assert router.allow_relation(cart, User()) is True
+
+
+def test_changed_carts_are_read_from_the_write_database(
+        routed, replicated, new_proxy, products):
+    proxy = new_proxy()
+    with CaptureQueriesContext(connections['replica']) as replica, \
+            CaptureQueriesContext(connections['default']) as default:
+        assert proxy.is_empty() is True
+    assert len(replica) > 0
+    assert len(default) == 0
+
+    proxy.add_item(products[0], Decimal('10'), 2)
+    with CaptureQueriesContext(connections['replica']) as replica:
+        assert proxy.total_price() == 20
+        assert [i.content_object for i in proxy] == products[:1]
+    assert len(replica) == 0
+
+    # Later requests read from the replica again
+    assert new_proxy().total_price() == 0
+
+
+def test_user_cart_missing_from_the_replica(routed, new_request, products):
+    user = products[0]
+    cart = CartProxy.new_cart(user=user)
+    assert CartProxy.get_cart(new_request(user)) == cart
+    assert Cart.objects.using('default').filter(user=user).count() == 1
+
+
+def test_pin_seconds(routed, settings, replicated, new_proxy, products):
+    settings.CART_PIN_SECONDS = 60
+    assert is_pinned(replicated.pk) is False
+    new_proxy().add_item(products[0], Decimal('10'), 2)
+    assert is_pinned(replicated.pk) is True
+    assert new_proxy().total_price() == 20
+
+
+def test_without_replica(settings, new_proxy, products):
+    settings.CART_PIN_SECONDS = 60
+    proxy = new_proxy()
+    proxy.add_item(products[0], Decimal('10'))
+    assert is_pinned(proxy.cart.pk) is False
+    assert proxy.total_price() == 10
+
+
+def test_bulk_writes_in_a_transaction_of_the_write_database(
+        settings, new_proxy, products, monkeypatch):
+    settings.DATABASE_ROUTERS = ['changuito.routers.CartRouter']
+    settings.CART_WRITE_DATABASE = 'replica'
+    # Items reference the content types of the write database
+    content_type = ContentType.objects.get_for_model(User)
+    ContentType.objects.using('replica').filter(
+        app_label='auth', model='user').delete()
+    content_type.save(using='replica')
+    proxy = new_proxy()
+    proxy.add_item(products[0], Decimal('10'))
+    assert proxy.cart._state.db == 'replica'
+
+    atomic = []
+    create_items = CartProxy._create_items
+
+    def spy(self, items, db):
+        atomic.append((db, connections[db].in_atomic_block))
+        return create_items(self, items, db)
+    monkeypatch.setattr(CartProxy, '_create_items', spy)
+    proxy.add_items([(products[0], Decimal('10'), 1),
+                     (products[1], Decimal('5'), 2)])
+    assert atomic == [('replica', True)]
+    assert Item.objects.using('replica').count() == 2
+    assert Item.objects.using('default').count() == 0
+    assert proxy.total_quantity() == 4
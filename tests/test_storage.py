@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+from decimal import Decimal
+
+import pytest
+from django.contrib.auth import user_logged_in
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sites.models import Site
+from django.http import HttpRequest, HttpResponse
+
+from changuito.exceptions import ItemDoesNotExist, ItemIsDetached
+from changuito.middleware import CartMiddleware
+from changuito.models import Cart, Item
+from changuito.proxy import CART_ID, CartProxy
+from changuito.storage import (CART_KEY, CacheCartProxy, CookieCartProxy,
+                               update_cart_cookie)
+
+
+def _get_response(request):
+    return HttpResponse()
+
+
+@pytest.fixture(params=[CartProxy, CacheCartProxy, CookieCartProxy])
+def proxy_class(request):
+    return request.param
+
+
+def _item_id(item):
+    return item.pk if item.line_id is None else item.line_id
+
+
+@pytest.mark.django_db
+def test_add_and_get_item(proxy_class, rqst, products):
+    proxy = proxy_class(rqst)
+    item = proxy.add_item(products[0], Decimal('125'), 1)
+    proxy.add_item(products[0], Decimal('125'), 2)
+    assert proxy.is_empty() is False
+    assert proxy.get_item(_item_id(item)).quantity == 3
+    assert proxy.cart.total_price() == 375
+    assert proxy.summary()['item_count'] == 1
+
+
+@pytest.mark.django_db
+def test_remove_item(proxy_class, rqst, products):
+    proxy = proxy_class(rqst)
+    item = proxy.add_item(products[0], Decimal('1'))
+    proxy.remove_item(_item_id(item))
+    assert proxy.is_empty() is True
+    with pytest.raises(ItemDoesNotExist):
+        proxy.remove_item(_item_id(item))
+    with pytest.raises(ItemDoesNotExist):
+        proxy.get_item(_item_id(item))
+
+
+@pytest.mark.django_db
+def test_update_item_quantity(proxy_class, rqst, products):
+    proxy = proxy_class(rqst)
+    proxy.add_item(products[0], Decimal('2'))
+    proxy.update_item_quantity(products[0], 5)
+    assert [item.quantity for item in proxy] == [5]
+    assert proxy.cart.total_quantity() == 5
+    with pytest.raises(ItemDoesNotExist):
+        proxy.update_item_quantity(products[1], 5)
+
+
+@pytest.mark.django_db
+def test_floats_and_strings(proxy_class, rqst, products):
+    proxy = proxy_class(rqst)
+    proxy.add_item(products[0], 2.5, 1.5)
+    proxy.add_items([(products[0], '2.50', '0.5'), (products[1], 1, 1)])
+    proxy.update_item_quantity(products[1], 2.0)
+    assert proxy.summary() == {'total_price': Decimal('7'),
+                               'total_quantity': Decimal('4'),
+                               'item_count': 2}
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('proxy_class', [CacheCartProxy, CookieCartProxy])
+def test_detached_items_are_read_only(proxy_class, new_proxy, rqst,
+                                      products):
+    saved = new_proxy().add_item(products[1], Decimal('7'), 4)
+    proxy = proxy_class(rqst)
+    # The line gets the id of the saved item
+    proxy.data['seq'] = saved.pk - 1
+    item = proxy.add_item(products[0], Decimal('2'))
+    assert item.pk is None and item.line_id == saved.pk
+    with pytest.raises(ItemIsDetached):
+        item.update_quantity(5)
+    with pytest.raises(ItemIsDetached):
+        item.update_price(Decimal('1'))
+    with pytest.raises(ItemIsDetached):
+        item.delete()
+    saved = Item.objects.get(pk=saved.pk)
+    assert (saved.quantity, saved.unit_price) == (4, 7)
+    assert Item.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_iteration_and_clear(proxy_class, rqst, products):
+    proxy = proxy_class(rqst)
+    site = Site.objects.get_current()
+    proxy.add_items([(product, Decimal('1'), 1) for product in products])
+    proxy.add_item(site, Decimal('3'))
+    assert [item.content_object for item in proxy] == products + [site]
+    proxy.clear_items()
+    assert list(proxy) == []
+    assert proxy.is_empty() is True
+
+
+@pytest.mark.django_db
+def test_checkout(proxy_class, rqst, products):
+    proxy = proxy_class(rqst)
+    proxy.add_item(products[0], Decimal('10'), 2)
+    cart = proxy.checkout()
+    assert cart.checked_out is True
+    assert Cart.objects.get(pk=cart.pk).total_price() == 20
+
+
+@pytest.mark.django_db
+def test_cache_cart_survives_requests(rqst, products):
+    CacheCartProxy(rqst).add_item(products[0], Decimal('10'))
+    assert CART_KEY in rqst.session
+    proxy = CacheCartProxy(rqst)
+    assert proxy.cart.total_price() == 10
+    assert Cart.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_empty_cache_cart_is_not_stored(rqst, django_assert_num_queries):
+    with django_assert_num_queries(0):
+        proxy = CacheCartProxy(rqst)
+        assert proxy.is_empty() is True
+    assert rqst.session == {}
+
+
+@pytest.mark.django_db
+def test_middleware_uses_anonymous_proxy(settings, rqst):
+    settings.CART_ANONYMOUS_PROXY = 'changuito.storage.CacheCartProxy'
+    CartMiddleware(_get_response).process_request(rqst)
+    assert isinstance(rqst.cart, CacheCartProxy)
+
+
+@pytest.mark.django_db
+def test_promote_on_login(settings, rqst, products):
+    settings.CART_ANONYMOUS_PROXY = 'changuito.storage.CacheCartProxy'
+    CacheCartProxy(rqst).add_items([(product, Decimal('1'), 1)
+                                    for product in products[:3]])
+    user = User.objects.create(username='buyer')
+    user_cart = CartProxy.new_cart(user=user)
+    rqst.user = user
+    user_logged_in.send(sender=User, request=rqst, user=user)
+    assert rqst.cart.cart == user_cart
+    assert user_cart.total_quantity() == 3
+    assert CART_KEY not in rqst.session
+
+
+@pytest.mark.django_db
+def test_promote_with_policy(rqst, products):
+    user = User.objects.create(username='buyer')
+    user_proxy = CartProxy(rqst, lazy=True)
+    user_proxy.cart = CartProxy.new_cart(user=user)
+    user_proxy.add_item(products[0], Decimal('1'), 2)
+    anonymous = CacheCartProxy(rqst)
+    anonymous.add_items([(products[0], Decimal('1'), 5),
+                         (products[1], Decimal('1'), 1)])
+    proxy = anonymous.promote(user, policy='keep-user')
+    assert dict((item.object_id, item.quantity) for item in proxy) == {
+        products[0].pk: 2, products[1].pk: 1}
+
+
+def _next_request(response, session):
+    r = HttpRequest()
+    r.session = session
+    r.user = AnonymousUser()
+    r.COOKIES = dict((name, morsel.value)
+                     for name, morsel in response.cookies.items())
+    return r
+
+
+@pytest.mark.django_db
+def test_cookie_cart(settings, rqst, products, django_assert_num_queries):
+    settings.CART_ANONYMOUS_PROXY = 'changuito.storage.CookieCartProxy'
+    middleware = CartMiddleware(_get_response)
+    with django_assert_num_queries(0):
+        middleware.process_request(rqst)
+        rqst.cart.add_item(products[0], Decimal('10'), 2)
+        response = middleware.process_response(rqst, HttpResponse())
+    assert response.cookies['changuito_cart']['httponly'] is True
+    assert rqst.session == {}
+
+    request = _next_request(response, rqst.session)
+    middleware.process_request(request)
+    assert isinstance(request.cart, CookieCartProxy)
+    assert request.cart.total_price() == 20
+    request.cart.clear_items()
+    response = middleware.process_response(request, HttpResponse())
+    assert response.cookies['changuito_cart'].value == ''
+    assert Cart.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_tampered_cookie_is_ignored(rqst, products):
+    CookieCartProxy(rqst).add_item(products[0], Decimal('10'))
+    response = HttpResponse()
+    update_cart_cookie(rqst, response)
+    request = _next_request(response, {})
+    request.COOKIES['changuito_cart'] += 'x'
+    assert CookieCartProxy(request).is_empty() is True
+
+
+@pytest.mark.django_db
+def test_cookie_cart_spills_to_database(settings, rqst, products):
+    settings.CART_ANONYMOUS_PROXY = 'changuito.storage.CookieCartProxy'
+    settings.CART_COOKIE_MAX_SIZE = 110
+    CartMiddleware(_get_response).process_request(rqst)
+    proxy = rqst.cart
+    proxy.add_item(products[0], Decimal('10'))
+    assert Cart.objects.count() == 0
+    item = proxy.add_item(products[1], Decimal('5'), 2)
+    cart = Cart.objects.get()
+    assert item.pk and item.quantity == 2
+    assert rqst.session[CART_ID] == cart.pk
+    assert rqst.cart.cart == cart
+    proxy.add_item(products[2], Decimal('1'))
+    assert cart.total_price() == 21
+
+    response = CartMiddleware(_get_response).process_response(rqst, HttpResponse())
+    request = _next_request(response, rqst.session)
+    CartMiddleware(_get_response).process_request(request)
+    assert type(request.cart) is CartProxy
+    assert request.cart.cart == cart
+
+
+@pytest.mark.django_db
+def test_cookie_cart_promoted_on_login(settings, rqst, products):
+    settings.CART_ANONYMOUS_PROXY = 'changuito.storage.CookieCartProxy'
+    CookieCartProxy(rqst).add_item(products[0], Decimal('10'))
+    user = User.objects.create(username='buyer')
+    rqst.user = user
+    user_logged_in.send(sender=User, request=rqst, user=user)
+    assert CartProxy.get_user_last_cart(user).total_price() == 10
+    rqst.COOKIES['changuito_cart'] = 'stale'
+    response = HttpResponse()
+    update_cart_cookie(rqst, response)
+    assert response.cookies['changuito_cart'].value == ''
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+from decimal import Decimal
+
+import pytest
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from changuito.models import reprice_open_carts
+from changuito.products import get_content_type_id
+from changuito.proxy import CartProxy
+from changuito.storage import CacheCartProxy
+from changuito.views import cart_snapshot
+
+
+@pytest.mark.django_db
+def test_snapshot(new_request, new_proxy, products, django_assert_num_queries):
+    proxy = new_proxy()
+    proxy.add_item(products[1], Decimal('2.50'), 2)
+    proxy.add_item(products[0], Decimal('10'))
+
+    proxy = new_proxy()
+    with django_assert_num_queries(2):
+        snapshot = proxy.snapshot()
+        assert proxy.snapshot() is snapshot
+    content_type_id = get_content_type_id(User)
+    assert [(line['content_type_id'], line['object_id'], line['quantity'],
+             line['unit_price'], line['total_price'])
+            for line in snapshot['lines']] == [
+        (content_type_id, products[1].pk, '2.000', '2.50', '5.00000'),
+        (content_type_id, products[0].pk, '1.000', '10.00', '10.00000')]
+    assert snapshot['total_price'] == '15.00000'
+    assert snapshot['total_quantity'] == '3.000'
+    assert snapshot['item_count'] == 2
+    assert json.loads(json.dumps(snapshot)) == snapshot
+
+    version = snapshot['version']
+    assert CartProxy(new_request()).snapshot()['version'] == version
+    proxy.update_item_quantity(products[0], 2)
+    assert proxy.snapshot()['version'] != version
+
+
+@pytest.mark.django_db
+def test_snapshot_of_serialized_carts(settings, new_request, products):
+    settings.CART_SNAPSHOT_CACHE = 'default'
+    proxy = CacheCartProxy(new_request())
+    proxy.add_item(products[0], Decimal('10'), 2)
+    snapshot = proxy.snapshot()
+    assert snapshot['total_price'] == '20'
+    assert snapshot['lines'][0]['object_id'] == products[0].pk
+    assert snapshot['version']
+
+
+@pytest.mark.django_db
+def test_cart_snapshot_view(new_request, new_proxy, products):
+    new_proxy().add_item(products[0], Decimal('10'), 2)
+    response = cart_snapshot(new_request())
+    assert response.status_code == 200
+    assert json.loads(response.content)['total_price'] == '20.00000'
+    assert response['Cache-Control'] == 'private, no-cache'
+
+    etag = response['ETag']
+    assert cart_snapshot(new_request(HTTP_IF_NONE_MATCH=etag)).status_code == 304
+    new_proxy().add_item(products[1], Decimal('1'))
+    response = cart_snapshot(new_request(HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+
+@pytest.mark.django_db
+def test_not_modified_without_queries(snapshots, new_request, new_proxy,
+                                      products, django_assert_num_queries):
+    new_proxy().add_item(products[0], Decimal('10'), 2)
+    etag = cart_snapshot(new_request())['ETag']
+    with django_assert_num_queries(0):
+        response = cart_snapshot(new_request(HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+
+    new_proxy().add_item(products[0], Decimal('10'))
+    response = cart_snapshot(new_request(HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 200
+    assert json.loads(response.content)['item_count'] == 1
+
+
+@pytest.mark.django_db
+def test_not_modified_reads_the_cart_row_only(new_request, new_proxy,
+                                              products):
+    proxy = new_proxy()
+    proxy.add_item(products[0], Decimal('10'), 2)
+    etag = cart_snapshot(new_request())['ETag']
+    with CaptureQueriesContext(connection) as captured:
+        response = cart_snapshot(new_request(HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 304
+    assert len(captured) == 1
+    assert 'changuito_item' not in captured[0]['sql']
+
+    # Changes made without the proxy replace the version too
+    proxy.cart.items.get().update_quantity(Decimal('3'))
+    response = cart_snapshot(new_request(HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 200
+    assert json.loads(response.content)['total_quantity'] == '3.000'
+    etag = response['ETag']
+    reprice_open_carts(products[0], Decimal('5'))
+    assert cart_snapshot(new_request(HTTP_IF_NONE_MATCH=etag))['ETag'] != etag